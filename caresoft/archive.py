@@ -0,0 +1,163 @@
+from typing import IO, Iterable, Iterator, Optional
+from datetime import date, datetime
+from functools import lru_cache
+from pathlib import Path
+import dataclasses
+import gzip
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+from caresoft.codec import dumps, loads
+from caresoft.context import get_context
+from caresoft.pipeline.interface import Pipeline
+from caresoft.repo import API_COUNT, Data
+from caresoft.request_parser import archived
+
+ARCHIVE_URI = os.getenv("ARCHIVE_URI")
+ARCHIVE_SPOOL_SIZE = 16 * 1024 * 1024
+ARCHIVE_FILE_SIZE = 128 * 1024 * 1024
+
+
+@lru_cache(maxsize=1)
+def _get_storage_client():
+    from google.cloud import storage
+
+    return storage.Client()
+
+
+def _split(uri: str) -> tuple[str, str]:
+    bucket, _, prefix = uri[len("gs://") :].partition("/")
+    return bucket, prefix
+
+
+def _open() -> tuple[IO[bytes], gzip.GzipFile]:
+    buffer = tempfile.SpooledTemporaryFile(max_size=ARCHIVE_SPOOL_SIZE)
+    return buffer, gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=1)
+
+
+def _put(path: str, buffer: IO[bytes]) -> None:
+    if path.startswith("gs://"):
+        bucket, key = _split(path)
+        _get_storage_client().bucket(bucket).blob(key).upload_from_file(
+            buffer,
+            rewind=True,
+        )
+    else:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        buffer.seek(0)
+        with open(path, "wb") as f:
+            shutil.copyfileobj(buffer, f)
+
+
+def _list(name: str) -> list[str]:
+    root = f"{ARCHIVE_URI}/{name}"
+    if root.startswith("gs://"):
+        bucket, prefix = _split(root)
+        return sorted(
+            f"gs://{bucket}/{blob.name}"
+            for blob in _get_storage_client().list_blobs(bucket, prefix=f"{prefix}/")
+        )
+    return sorted(str(path) for path in Path(root).glob("dt=*/*.jsonl.gz"))
+
+
+def _get(path: str) -> IO[bytes]:
+    if path.startswith("gs://"):
+        bucket, key = _split(path)
+        buffer = tempfile.SpooledTemporaryFile(max_size=ARCHIVE_SPOOL_SIZE)
+        _get_storage_client().bucket(bucket).blob(key).download_to_file(buffer)
+        buffer.seek(0)
+        return buffer
+    return open(path, "rb")
+
+
+def archive(name: str, chunks: Iterable[Data]) -> Iterator[Data]:
+    """Pass chunks through, writing every raw row to
+    `{ARCHIVE_URI}/{name}/dt={today}/{uuid}.jsonl.gz` on the way."""
+    if not ARCHIVE_URI:
+        yield from chunks
+        return
+
+    prefix = f"{ARCHIVE_URI}/{name}/dt={datetime.utcnow().date().isoformat()}"
+    buffer, file = _open()
+    rows_written = 0
+    try:
+        for rows in chunks:
+            file.write(b"".join(dumps(row) + b"\n" for row in rows))
+            rows_written += len(rows)
+            if buffer.tell() >= ARCHIVE_FILE_SIZE:
+                file.close()
+                _put(f"{prefix}/{uuid.uuid4().hex}.jsonl.gz", buffer)
+                buffer.close()
+                buffer, file = _open()
+                rows_written = 0
+            yield rows
+
+        file.close()
+        if rows_written:
+            _put(f"{prefix}/{uuid.uuid4().hex}.jsonl.gz", buffer)
+    finally:
+        buffer.close()
+
+
+def _partition(path: str) -> str:
+    return path.rsplit("/dt=", 1)[-1][:10]
+
+
+def _read(path: str) -> Iterator[Data]:
+    with _get(path) as buffer, gzip.GzipFile(fileobj=buffer) as file:
+        rows: Data = []
+        for line in file:
+            rows.append(loads(line))
+            if len(rows) == API_COUNT:
+                yield rows
+                rows = []
+        if rows:
+            yield rows
+
+
+def replay(name: str):
+    def _replay(dates: tuple[Optional[date], Optional[date]]) -> Iterator[Data]:
+        """Rows archived for `name` within `dates`, file by file. Once the run's
+        deadline passes, the `dt=` partitions not yet started are left in
+        `pending_dates` for a continuation task instead."""
+        start, end = [i.isoformat() if i else None for i in dates]
+        paths = [
+            path
+            for path in _list(name)
+            if not (start and _partition(path) < start)
+            and not (end and _partition(path) > end)
+        ]
+        context = get_context()
+
+        def __replay() -> Iterator[Data]:
+            for i, path in enumerate(paths):
+                if (
+                    context.deadline is not None
+                    and time.monotonic() >= context.deadline
+                ):
+                    context.pending_dates.extend(
+                        sorted({_partition(path) for path in paths[i:]})
+                    )
+                    return
+                yield from _read(path)
+
+        return __replay()
+
+    return _replay
+
+
+def replay_pipeline(pipeline: Pipeline) -> Pipeline:
+    if not (ARCHIVE_URI and pipeline.id_key and pipeline.cursor_key):
+        raise ValueError(f"{pipeline.name} cannot be replayed")
+    return dataclasses.replace(
+        pipeline,
+        params_fn=archived,
+        get=replay(pipeline.name),
+        stream=True,
+        queue_task=False,
+        watermark=False,
+        archive=False,
+    )
@@ -1,8 +1,31 @@
 from typing import Any
+from concurrent.futures import ThreadPoolExecutor
 
+from caresoft.archive import replay_pipeline
 from caresoft.pipeline import pipelines, details_pipelines
+from caresoft.pipeline.interface import Pipeline
 from caresoft.caresoft_service import pipeline_service
 
 
+def _isolated(pipeline: Pipeline, body: dict[str, Any]) -> dict[str, Any]:
+    try:
+        return pipeline_service(pipeline, body)
+    except Exception as e:
+        print(pipeline.name, repr(e))
+        return {"error": repr(e)}
+
+
 def caresoft_controller(body: dict[str, Any]):
-    return pipeline_service((pipelines | details_pipelines)[body["table"]], body)
+    _pipelines = pipelines | details_pipelines
+    if "tables" in body:
+        tables: list[str] = body["tables"]
+        with ThreadPoolExecutor(max_workers=max(len(tables), 1)) as executor:
+            responses = executor.map(
+                lambda table: _isolated(_pipelines[table], body),
+                tables,
+            )
+            return dict(zip(tables, responses))
+    pipeline = _pipelines[body["table"]]
+    if body.get("replay"):
+        pipeline = replay_pipeline(pipeline)
+    return pipeline_service(pipeline, body)
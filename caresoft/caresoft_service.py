@@ -1,43 +1,165 @@
-from typing import Any
+from typing import Any, Iterable, Iterator, TypeVar
+from queue import Full, Queue
+import contextvars
+import threading
 
 from compose import compose
+from google.api_core.exceptions import GoogleAPICallError
 
+from caresoft.archive import archive
+from caresoft.context import RunContext, run_context
 from caresoft.pipeline.interface import Pipeline
-from caresoft.repo import Data
-from tasks.tasks_service import create_details_tasks_service
-from db.bigquery import load
+from caresoft.repo import DETAILS_LATENCY_ALPHA, DETAILS_MIN_LIMIT, Data
+from caresoft.telemetry import emit, record, timed, timed_iter
+from tasks.tasks_service import create_details_tasks_service, create_retry_tasks_service
+from db.bigquery import load, update_latency
+
+PIPELINE_QUEUE_SIZE = 4
+
+T = TypeVar("T")
+_DONE = object()
+
+
+def _buffered(iterable: Iterable[T], maxsize: int) -> Iterator[T]:
+    """Iterate on a worker thread, staying at most `maxsize` items ahead."""
+    queue: Queue = Queue(maxsize)
+    stop = threading.Event()
+
+    def _put(item: Any) -> None:
+        while not stop.is_set():
+            try:
+                return queue.put(item, timeout=0.1)
+            except Full:
+                pass
+
+    def _produce() -> None:
+        try:
+            for item in iterable:
+                _put((item, None))
+                if stop.is_set():
+                    return
+            _put((_DONE, None))
+        except Exception as e:
+            _put((_DONE, e))
+
+    thread = threading.Thread(
+        target=contextvars.copy_context().run,
+        args=(_produce,),
+        daemon=True,
+    )
+    thread.start()
+    try:
+        while True:
+            item, error = queue.get()
+            if error:
+                raise error
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def transform_service(pipeline: Pipeline):
+    def _svc(data) -> Iterator[Data]:
+        def _transform(rows: Data) -> Data:
+            with timed("transform"):
+                record("transform", rows=len(rows))
+                return pipeline.transform(rows)
+
+        def _archive(chunks: Iterable[Data]) -> Iterator[Data]:
+            if not pipeline.archive:
+                return iter(chunks)
+            return timed_iter("archive", archive(pipeline.name, chunks))
+
+        if pipeline.stream:
+            return timed_iter(
+                "wait",
+                _buffered(
+                    map(_transform, _archive(timed_iter("fetch", data))),
+                    PIPELINE_QUEUE_SIZE,
+                ),
+            )
+        return iter([_transform(rows) for rows in _archive([data])])
+
+    return _svc
 
 
 def load_callback_service(pipeline: Pipeline):
-    def _svc(rows: Data) -> dict[str, Any]:
-        return {
-            "output_rows": load(
+    def _svc(chunks: Iterable[Data]) -> dict[str, Any]:
+        keys: Data = []
+
+        def _collect(chunks: Iterable[Data]) -> Iterator[Data]:
+            for rows in chunks:
+                if pipeline.queue_task and pipeline.id_key and pipeline.cursor_key:
+                    keys.extend(
+                        {
+                            pipeline.id_key: row[pipeline.id_key],
+                            pipeline.cursor_key: row[pipeline.cursor_key],
+                        }
+                        for row in rows
+                    )
+                yield rows
+
+        with timed("load"):
+            output_rows = load(
                 pipeline.name,
                 pipeline.schema,
                 pipeline.id_key,
                 pipeline.cursor_key,
-                rows,
-            ),
-            **(
-                {
-                    "callback_res": create_details_tasks_service(
-                        f"{pipeline.name}Details",
-                        pipeline.id_key,
-                        rows,
-                    )
-                }
-                if pipeline.queue_task and pipeline.id_key
-                else {}
-            ),
-        }
+                _collect(chunks),
+                pipeline.watermark,
+                pipeline.partition_key,
+                pipeline.cluster_keys,
+                pipeline.sink,
+            )
+            record("load", output_rows=output_rows)
+        if not (pipeline.queue_task and pipeline.id_key and pipeline.cursor_key):
+            return {"output_rows": output_rows}
+
+        with timed("callback"):
+            callback_res = create_details_tasks_service(
+                f"{pipeline.name}Details",
+                pipeline.id_key,
+                pipeline.cursor_key,
+                keys,
+            )
+            record("callback", tasks=callback_res["tasks"])
+        return {"output_rows": output_rows, "callback_res": callback_res}
 
     return _svc
 
 
+def _save_latency(table: str, context: RunContext) -> None:
+    fetch = context.stats["fetch"]
+    try:
+        update_latency(
+            table,
+            fetch["details_seconds"] / fetch["details"],
+            DETAILS_LATENCY_ALPHA,
+        )
+    except GoogleAPICallError as e:
+        print(table, repr(e))
+
+
 def pipeline_service(pipeline: Pipeline, body: dict[str, Any]):
-    return compose(
-        load_callback_service(pipeline),
-        pipeline.transform,
-        pipeline.get,
-        pipeline.params_fn(pipeline.name, pipeline.cursor_key),
-    )(body)
+    with run_context() as context:
+        try:
+            with timed("params"):
+                params = pipeline.params_fn(pipeline.name, pipeline.cursor_key)(body)
+            with timed("fetch"):
+                data = pipeline.get(params)
+            response = compose(
+                load_callback_service(pipeline),
+                transform_service(pipeline),
+            )(data)
+            with timed("retry"):
+                retry_res = create_retry_tasks_service(
+                    pipeline.name, body, params, context
+                )
+            if context.stats["fetch"]["details"] >= DETAILS_MIN_LIMIT:
+                _save_latency(pipeline.name, context)
+        finally:
+            emit(pipeline.name, context)
+    return {**response, **retry_res}
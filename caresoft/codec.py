@@ -0,0 +1,14 @@
+from typing import Any, Callable, Union
+from importlib.util import find_spec
+import json
+
+if find_spec("orjson") is not None:
+    import orjson
+
+    loads: Callable[[Union[bytes, str]], Any] = orjson.loads
+    dumps: Callable[[Any], bytes] = orjson.dumps
+else:
+    loads = json.loads
+
+    def dumps(obj: Any) -> bytes:
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode()
@@ -0,0 +1,47 @@
+from typing import ContextManager, Iterator, Optional
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+import time
+
+FUNCTION_TIMEOUT = 530
+DEADLINE_MARGIN = 60
+
+
+@dataclass
+class RunContext:
+    deadline: Optional[float] = None
+    failed_pages: list[int] = field(default_factory=list)
+    failed_ids: list[int] = field(default_factory=list)
+    pending_pages: list[int] = field(default_factory=list)
+    pending_ids: list[int] = field(default_factory=list)
+    pending_dates: list[str] = field(default_factory=list)
+    found: Optional[int] = None
+    started: int = field(default_factory=time.time_ns)
+    stats: defaultdict[str, defaultdict[str, float]] = field(
+        default_factory=lambda: defaultdict(lambda: defaultdict(int))
+    )
+    stages: dict[int, tuple[Optional[str], float, float]] = field(default_factory=dict)
+
+
+_context: ContextVar[RunContext] = ContextVar("run_context")
+
+
+def get_context() -> RunContext:
+    return _context.get(None) or RunContext()
+
+
+@contextmanager
+def bind_context(context: RunContext) -> Iterator[RunContext]:
+    token = _context.set(context)
+    try:
+        yield context
+    finally:
+        _context.reset(token)
+
+
+def run_context() -> ContextManager[RunContext]:
+    return bind_context(
+        RunContext(deadline=time.monotonic() + FUNCTION_TIMEOUT - DEADLINE_MARGIN)
+    )
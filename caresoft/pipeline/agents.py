@@ -7,23 +7,6 @@ pipeline = Pipeline(
     name="Agents",
     params_fn=dimension,
     get=get_dimension("agents", lambda x: x["agents"]),
-    transform=lambda rows: [
-        {
-            "id": row.get("id"),
-            "username": row.get("username"),
-            "email": row.get("email"),
-            "phone_no": row.get("phone_no"),
-            "agent_id": row.get("agent_id"),
-            "created_at": row.get("created_at"),
-            "updated_at": row.get("updated_at"),
-            "group_id": row.get("group_id"),
-            "group_name": row.get("group_name"),
-            "role_id": row.get("role_id"),
-            "login_status": row.get("login_status"),
-            "call_status": row.get("call_status"),
-        }
-        for row in rows
-    ],
     schema=[
         {"name": "id", "type": "INTEGER"},
         {"name": "username", "type": "STRING"},
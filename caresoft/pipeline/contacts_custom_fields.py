@@ -6,23 +6,6 @@ pipeline = Pipeline(
     name="ContactsCustomFields",
     params_fn=dimension,
     get=get_dimension("contacts/custom_fields", lambda x: x["custom_fields"]),
-    transform=lambda rows: [
-        {
-            "custom_field_id": row.get("custom_field_id"),
-            "custom_field_lable": row.get("custom_field_lable"),
-            "type": row.get("type"),
-            "values": [
-                {
-                    "id": value.get("id"),
-                    "lable": value.get("lable"),
-                }
-                for value in row.get("values", [])
-            ]
-            if row.get("values")
-            else [],
-        }
-        for row in rows
-    ],
     schema=[
         {"name": "custom_field_id", "type": "INTEGER"},
         {"name": "custom_field_lable", "type": "STRING"},
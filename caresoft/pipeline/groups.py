@@ -6,14 +6,6 @@ pipeline = Pipeline(
     name="Groups",
     params_fn=dimension,
     get=get_dimension("groups", lambda x: x["groups"]),
-    transform=lambda rows: [
-        {
-            "group_id": row.get("group_id"),
-            "group_name": row.get("group_name"),
-            "created_at": row.get("created_at"),
-        }
-        for row in rows
-    ],
     schema=[
         {"name": "group_id", "type": "INTEGER"},
         {"name": "group_name", "type": "STRING"},
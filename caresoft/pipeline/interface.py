@@ -1,7 +1,10 @@
-from typing import Callable, Any, Optional, Protocol
-from dataclasses import dataclass
+from typing import Callable, Any, Iterable, Optional, Protocol, Union
+from dataclasses import dataclass, field
 
 from caresoft.repo import Data
+from caresoft.pipeline.transform import compile_transform
+
+SINKS = ("load", "storage_write")
 
 
 class ParamsFn(Protocol):
@@ -13,9 +16,25 @@ class ParamsFn(Protocol):
 class Pipeline:
     name: str
     params_fn: ParamsFn
-    get: Callable[[Any], Data]
-    transform: Callable[[Data], Data]
+    get: Callable[[Any], Union[Data, Iterable[Data]]]
     schema: list[dict[str, Any]]
     id_key: Optional[str] = None
     cursor_key: Optional[str] = None
     queue_task: bool = False
+    stream: bool = False
+    count: Optional[Callable[[Any], int]] = None
+    watermark: bool = False
+    partition_key: Optional[str] = None
+    cluster_keys: list[str] = field(default_factory=list)
+    sink: str = "load"
+    archive: bool = True
+    transform: Callable[[Data], Data] = field(init=False)
+
+    def __post_init__(self):
+        if self.sink not in SINKS:
+            raise ValueError(f"{self.name}: unknown sink {self.sink}")
+        if self.sink != "load" and not (self.id_key and self.cursor_key):
+            raise ValueError(
+                f"{self.name}: sink {self.sink} needs id_key and cursor_key"
+            )
+        self.transform = compile_transform(self.schema)
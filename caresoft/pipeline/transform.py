@@ -0,0 +1,40 @@
+from typing import Any, Callable
+import json
+
+from caresoft.repo import Data
+
+Schema = list[dict[str, Any]]
+
+
+def _compile_record(schema: Schema, var: str, depth: int) -> str:
+    items = []
+    for field in schema:
+        type_, mode = field["type"].upper(), field.get("mode", "").upper()
+        value = f"{var}.get({field['name']!r})"
+        if type_ in ("RECORD", "STRUCT"):
+            child = f"_{depth + 1}"
+            record = _compile_record(field["fields"], child, depth + 1)
+            value = (
+                f"[{record} for {child} in {value} or ()]"
+                if mode == "REPEATED"
+                else f"({record} if ({child} := {value}) else {{}})"
+            )
+        elif mode == "REPEATED":
+            value = f"({value} or [])"
+        elif type_ == "STRING" and not depth:
+            value = f"(_dumps(_s) if type(_s := {value}) in _objects else _s)"
+        items.append(f"{field['name']!r}: {value}")
+    return "{" + ", ".join(items) + "}"
+
+
+def compile_transform(schema: Schema) -> Callable[[Data], Data]:
+    namespace: dict[str, Any] = {"_dumps": json.dumps, "_objects": (dict, list)}
+    exec(
+        "def _transform(rows):\n"
+        "    data = []\n"
+        "    for _0 in rows:\n"
+        f"        data.append({_compile_record(schema, '_0', 0)})\n"
+        "    return data\n",
+        namespace,
+    )
+    return namespace["_transform"]
@@ -0,0 +1,85 @@
+from typing import Optional
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import asyncio
+import random
+import time
+
+import httpx
+
+
+class RateLimiter:
+    """Token bucket whose refill rate adapts to 429 responses (AIMD).
+
+    Every success adds roughly `increase` req/s per second of traffic, every
+    burst of 429s halves the rate and pauses the bucket for `Retry-After`.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        max_rate: Optional[float] = None,
+        min_rate: float = 1,
+        burst: int = 1,
+        increase: float = 0.5,
+        decrease: float = 0.5,
+    ):
+        self.rate = rate
+        self.max_rate = max_rate or rate
+        self.min_rate = min_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self._next = 0.0
+        self._paused_until = 0.0
+        self._cooldown_until = 0.0
+
+    async def acquire(self) -> None:
+        now = time.monotonic()
+        slot = max(
+            now,
+            self._paused_until,
+            self._next - (self.burst - 1) / self.rate,
+        )
+        self._next = max(self._next, slot) + 1 / self.rate
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def __aenter__(self) -> None:
+        await self.acquire()
+
+    async def __aexit__(self, *args) -> None:
+        pass
+
+    def on_success(self) -> None:
+        self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def on_throttle(self, retry_after: Optional[float] = None) -> None:
+        now = time.monotonic()
+        if now >= self._cooldown_until:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self._cooldown_until = now + 1
+        if retry_after:
+            self._paused_until = max(self._paused_until, now + retry_after)
+
+
+def backoff(attempt: int, retry_after: Optional[float] = None, base: float = 0.5):
+    return max(retry_after or 0, random.uniform(0, base * 2**attempt))
+
+
+def retry_after(response: httpx.Response) -> Optional[float]:
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        try:
+            return max(
+                (
+                    parsedate_to_datetime(value) - datetime.now(timezone.utc)
+                ).total_seconds(),
+                0,
+            )
+        except (TypeError, ValueError):
+            return None
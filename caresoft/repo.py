@@ -1,137 +1,506 @@
 import os
 import sys
-from typing import Callable, Any, Union
+from typing import (
+    Awaitable,
+    Callable,
+    Any,
+    Optional,
+    Union,
+    AsyncGenerator,
+    AsyncIterator,
+    Iterator,
+)
+from collections import Counter, deque
+from importlib.util import find_spec
 import asyncio
 import math
+import threading
+import time
 
 import httpx
-from asyncio_throttle import Throttler
+
+from caresoft.codec import loads
+from caresoft.context import bind_context, get_context
+from caresoft.rate_limiter import RateLimiter, backoff, retry_after
+from caresoft.telemetry import record
+from caresoft.ttl_cache import TTLCache
 
 TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
 API_COUNT = 500
+API_PAGE_SIZES = (125, 250, 500)
 LISTING_API_REQ_PER_SEC = 6
+LISTING_WINDOW = 2 * LISTING_API_REQ_PER_SEC
+LISTING_RATE_ALPHA = 0.3
+LISTING_EXPLORE_EVERY = 20
 DETAILS_API_REQ_PER_SEC = 12
+API_MAX_RETRIES = 5
+API_RETRY_ROUNDS = 3
 DETAILS_LIMIT = 2500
+DETAILS_MIN_LIMIT = 100
+DETAILS_LATENCY_ALPHA = 0.3
+BACKFILL_LIMIT = 100000
+API_MAX_CONNECTIONS = 20
+DETAILS_CACHE_SIZE = 10000
+DETAILS_CACHE_TTL = 600
+DETAILS_CACHE_BYTES = 32 * 1024 * 1024
 
 if sys.platform == "win32":
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
 
+_lock = threading.Lock()
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_client: Optional[httpx.AsyncClient] = None
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True).start()
+        return _loop
+
+
 def _get_client() -> httpx.AsyncClient:
-    return httpx.AsyncClient(
-        base_url="https://api.caresoft.vn/VUANEM/api/v1/",
-        headers={
-            "Authorization": f"Bearer {os.getenv('ACCESS_TOKEN')}",
-            "Content-Type": "application/json",
-        },
-        timeout=None,
-    )
+    global _client
+    with _lock:
+        if _client is None:
+            _client = httpx.AsyncClient(
+                base_url="https://api.caresoft.vn/VUANEM/api/v1/",
+                headers={
+                    "Authorization": f"Bearer {os.getenv('ACCESS_TOKEN')}",
+                    "Content-Type": "application/json",
+                },
+                timeout=httpx.Timeout(60, connect=10, pool=None),
+                limits=httpx.Limits(
+                    max_connections=API_MAX_CONNECTIONS,
+                    max_keepalive_connections=API_MAX_CONNECTIONS,
+                    keepalive_expiry=60,
+                ),
+                http2=find_spec("h2") is not None,
+            )
+        return _client
+
+
+def _run(aw: Awaitable):
+    context = get_context()
+
+    async def _await():
+        with bind_context(context):
+            return await aw
+
+    return asyncio.run_coroutine_threadsafe(_await(), _get_loop()).result()
 
 
 Row = dict
 Data = list[Row]
 ResFn = Callable[[dict[str, Any]], Any]
 
+_listing_limiter = RateLimiter(
+    LISTING_API_REQ_PER_SEC,
+    max_rate=2 * LISTING_API_REQ_PER_SEC,
+)
+_details_limiter = RateLimiter(
+    DETAILS_API_REQ_PER_SEC,
+    max_rate=2 * DETAILS_API_REQ_PER_SEC,
+)
+_details_cache = TTLCache(DETAILS_CACHE_SIZE, DETAILS_CACHE_TTL, DETAILS_CACHE_BYTES)
+_details_latency = 1 / DETAILS_API_REQ_PER_SEC
+_listing_stats: dict[tuple[str, int], tuple[float, float]] = {}
+_listing_blocks: Counter = Counter()
+
+
+async def _request(
+    client: httpx.AsyncClient,
+    limiter: RateLimiter,
+    uri: str,
+    params: Optional[dict[str, Any]] = None,
+    latencies: Optional[list[float]] = None,
+) -> httpx.Response:
+    for attempt in range(API_MAX_RETRIES + 1):
+        async with limiter:
+            start = time.monotonic()
+            r = await client.get(uri, params=params)
+        record("fetch", requests=1, bytes=len(r.content))
+        if latencies is not None:
+            latencies.append(time.monotonic() - start)
+        if r.status_code != 429:
+            limiter.on_success()
+            return r
+        wait = retry_after(r)
+        record("fetch", throttled=1)
+        limiter.on_throttle(wait)
+        await asyncio.sleep(backoff(attempt, wait))
+    return r
+
+
+def _json(r: httpx.Response) -> Any:
+    start = time.perf_counter()
+    res = loads(r.content)
+    record("fetch", decode_seconds=time.perf_counter() - start)
+    return res
+
+
+async def _with_retries(
+    fn: Callable[[Any], Awaitable[Any]],
+    keys: list[Any],
+    failed: list[Any],
+    pending: Optional[list[Any]] = None,
+    deadline: Optional[float] = None,
+    window: Optional[int] = None,
+) -> AsyncIterator[Any]:
+    async def _try(key):
+        try:
+            return key, await fn(key)
+        except httpx.HTTPError:
+            return key, None
+
+    def _remaining() -> Optional[float]:
+        return None if deadline is None else max(deadline - time.monotonic(), 0)
+
+    for attempt in range(API_RETRY_ROUNDS + 1):
+        if attempt:
+            wait = backoff(attempt)
+            if deadline is not None and wait >= _remaining():  # type: ignore
+                break
+            await asyncio.sleep(wait)
+            record("fetch", retries=len(keys))
+        queue: deque = deque(keys)
+        tasks: dict[asyncio.Task, Any] = {}
+        waiting: set[asyncio.Task] = set()
+        keys = []
+        try:
+            while queue or waiting:
+                while queue and (window is None or len(waiting) < window):
+                    key = queue.popleft()
+                    task = asyncio.create_task(_try(key))
+                    tasks[task] = key
+                    waiting.add(task)
+                done, waiting = await asyncio.wait(
+                    waiting,
+                    timeout=_remaining(),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for task in done:
+                    key, res = task.result()
+                    del tasks[task]
+                    if res is None:
+                        keys.append(key)
+                    else:
+                        yield res
+                if not done:
+                    break
+        finally:
+            for task in waiting:
+                task.cancel()
+        if waiting or queue:
+            (failed if pending is None else pending).extend(
+                [*(tasks[i] for i in waiting), *queue]
+            )
+            break
+        if not keys:
+            return
+    failed.extend(keys)
+
 
 def get_dimension(uri: str, res_fn: ResFn):
     def _get(*args):
         async def __get() -> Data:
-            async with _get_client() as client:
-                r = await client.get(uri)
-                res = r.json()
-                return res_fn(res)
+            r = await _get_client().get(uri)
+            res = _json(r)
+            return res_fn(res)
 
-        return asyncio.run(__get())
+        return _run(__get())
 
     return _get
 
 
 async def _get_one_listing(
     client: httpx.AsyncClient,
-    throttler: Throttler,
     params: dict[str, Any],
     uri: str,
     res_fn: ResFn,
     page: int = 1,
+    latencies: Optional[list[float]] = None,
 ) -> Union[Data, int]:
-    async with throttler:
-        r = await client.get(uri, params={**params, "page": page})
-        if r.status_code == 429:
-            await asyncio.sleep(0.5)
-            return await _get_one_listing(client, throttler, params, uri, res_fn, page)
-        elif r.status_code == 500:
-            return []
-        else:
-            r.raise_for_status()
-            res = r.json()
-            return res_fn(res)
+    r = await _request(
+        client,
+        _listing_limiter,
+        uri,
+        {**params, "page": page},
+        latencies,
+    )
+    r.raise_for_status()
+    res = _json(r)
+    return res_fn(res)
+
+
+def page_size(uri: str) -> int:
+    """Page size with the best expected rows per second for `uri`, i.e. rows
+    per request times the lesser of the listing rate and LISTING_WINDOW over
+    the request latency. Untried sizes are sampled first, then a neighbour
+    every LISTING_EXPLORE_EVERY blocks."""
+    untried = [i for i in API_PAGE_SIZES if (uri, i) not in _listing_stats]
+    if untried:
+        _listing_stats[(uri, untried[-1])] = (untried[-1], 0)
+        return untried[-1]
+
+    def _rows_per_sec(size: int) -> float:
+        rows, latency = _listing_stats[(uri, size)]
+        return rows * min(_listing_limiter.rate, LISTING_WINDOW / max(latency, 1e-3))
+
+    best = max(API_PAGE_SIZES, key=_rows_per_sec)
+    _listing_blocks[uri] += 1
+    explore, remainder = divmod(_listing_blocks[uri], LISTING_EXPLORE_EVERY)
+    if remainder:
+        return best
+    i = API_PAGE_SIZES.index(best) + (1 if explore % 2 else -1)
+    return API_PAGE_SIZES[min(max(i, 0), len(API_PAGE_SIZES) - 1)]
+
+
+def _observe_page(uri: str, size: int, rows: int, latency: float) -> None:
+    key = (uri, size)
+    if key in _listing_stats and _listing_stats[key][1]:
+        _rows, _latency = _listing_stats[key]
+        _listing_stats[key] = (
+            _rows + LISTING_RATE_ALPHA * (rows - _rows),
+            _latency + LISTING_RATE_ALPHA * (latency - _latency),
+        )
+    else:
+        _listing_stats[key] = (rows, latency)
+
+
+async def _get_one_block(
+    client: httpx.AsyncClient,
+    params: dict[str, Any],
+    uri: str,
+    res_fn: ResFn,
+    block: int,
+) -> Data:
+    """Rows of API_COUNT-sized page `block`, fetched as pages of `page_size`,
+    which divides API_COUNT so retries and continuations keep counting in
+    API_COUNT pages."""
+    size = page_size(uri)
+    per_block = API_COUNT // size
+    rows: Data = []
+    for page in range((block - 1) * per_block + 1, block * per_block + 1):
+        start = time.monotonic()
+        latencies: list[float] = []
+        try:
+            data: Data = await _get_one_listing(  # type: ignore
+                client,
+                {**params, "count": size},
+                uri,
+                res_fn,
+                page,
+                latencies,
+            )
+        except httpx.HTTPError:
+            _observe_page(uri, size, 0, time.monotonic() - start)
+            raise
+        rows.extend(data)
+        if len(data) < size:
+            break
+        _observe_page(uri, size, size, latencies[-1])
+    return rows
+
+
+def _iterate(pages: AsyncGenerator[Data, None]) -> Iterator[Data]:
+    try:
+        while True:
+            try:
+                yield _run(pages.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        _run(pages.aclose())
+
+
+def _widen(pages: list[int], found: int, now_found: int) -> list[int]:
+    """API_COUNT pages numbered when the window held `found` rows, widened to
+    wherever their rows can be now that it holds `now_found`: rows leaving
+    the window pull later rows onto earlier pages, rows entering it push
+    them onto later ones."""
+    back = math.ceil(max(found - now_found, 0) / API_COUNT)
+    ahead = math.ceil(max(now_found - found, 0) / API_COUNT)
+    last = math.ceil(now_found / API_COUNT)
+    return sorted(
+        {
+            page + shift
+            for page in pages
+            for shift in range(-back, ahead + 1)
+            if 1 <= page + shift <= last
+        }
+    )
 
 
 def get_listing(uri: str, res_fn: ResFn):
-    def _get(params: dict[str, str]):
-        async def __get() -> Data:
-            print(params)
-            throttler = Throttler(rate_limit=LISTING_API_REQ_PER_SEC, period=1)
-            async with _get_client() as client:
-                num_found: int = await _get_one_listing(  # type: ignore
+    def _get(params: dict[str, Any]) -> Iterator[Data]:
+        pages: Optional[list[int]] = params.get("pages")
+        found: Optional[int] = params.get("found")
+        params = {k: v for k, v in params.items() if k not in ("pages", "found")}
+        context = get_context()
+
+        async def __get() -> AsyncGenerator[Data, None]:
+            print(params, pages or "")
+            client = _get_client()
+            _pages = pages
+            if _pages is None:
+                start = time.monotonic()
+                latencies: list[float] = []
+                res: dict[str, Any] = await _get_one_listing(  # type: ignore
+                    client,
+                    {**params, "count": API_COUNT},
+                    uri,
+                    lambda x: x,
+                    latencies=latencies,
+                )
+                record(
+                    "fetch",
+                    pages=1,
+                    found=res["numFound"],
+                    probe_seconds=time.monotonic() - start,
+                )
+                data = res_fn(res)
+                if len(data) == API_COUNT:
+                    _observe_page(uri, API_COUNT, API_COUNT, latencies[-1])
+                context.found = res["numFound"]
+                yield data
+                _pages = list(range(2, int(math.ceil(res["numFound"] / API_COUNT)) + 1))
+            elif found is not None:
+                start = time.monotonic()
+                now_found: int = await _get_one_listing(  # type: ignore
                     client,
-                    throttler,
-                    params,
+                    {**params, "count": 1},
                     uri,
                     lambda x: x["numFound"],
                 )
-                tasks = [
-                    asyncio.create_task(
-                        _get_one_listing(
-                            client,
-                            throttler,
-                            params,
-                            uri,
-                            res_fn,
-                            page,
-                        )
-                    )
-                    for page in range(1, int(math.ceil(num_found / API_COUNT)) + 1)
-                ]
-                pages = await asyncio.gather(*tasks)
-                return [i for j in pages for i in j]
-
-        return asyncio.run(__get())
+                record(
+                    "fetch",
+                    found=now_found,
+                    probe_seconds=time.monotonic() - start,
+                )
+                context.found = now_found
+                _pages = _widen(_pages, found, now_found)
+
+            async for data in _with_retries(
+                lambda page: _get_one_block(client, params, uri, res_fn, page),
+                _pages,
+                context.failed_pages,
+                context.pending_pages,
+                context.deadline,
+                LISTING_WINDOW,
+            ):
+                record("fetch", pages=1)
+                yield data
+
+        return _iterate(__get())
 
     return _get
 
 
+def count_listing(uri: str):
+    def _count(params: dict[str, str]) -> int:
+        return _run(
+            _get_one_listing(
+                _get_client(),
+                {**params, "count": 1},
+                uri,
+                lambda x: x["numFound"],
+            )
+        )
+
+    return _count
+
+
+async def _fetch_one_id(
+    client: httpx.AsyncClient,
+    uri: str,
+    id: int,
+    res_fn: ResFn,
+) -> tuple[Row, int]:
+    r = await _request(client, _details_limiter, f"{uri}/{id}")
+    if r.status_code == 404:
+        return {}, len(r.content)
+    r.raise_for_status()
+    res = _json(r)
+    return res_fn(res), len(r.content)
+
+
 async def _get_one_id(
     client: httpx.AsyncClient,
-    throttler: Throttler,
     uri: str,
     id: int,
     res_fn: ResFn,
+    cursor: Optional[str] = None,
 ) -> Row:
-    async with throttler:
-        r = await client.get(f"{uri}/{id}")
-        if r.status_code in (404, 500):
-            return {}
-        elif r.status_code == 429:
-            await asyncio.sleep(0.5)
-            return await _get_one_id(client, throttler, uri, id, res_fn)
-        else:
-            res = r.json()
-            return res_fn(res)
+    if cursor is None:
+        row, _ = await _fetch_one_id(client, uri, id, res_fn)
+        return row
+
+    key = (uri, id, cursor)
+    future = _details_cache.get(key)
+    if future is not None:
+        record("fetch", cache_hits=1)
+    else:
+        future = asyncio.ensure_future(_fetch_one_id(client, uri, id, res_fn))
+        future.add_done_callback(lambda future: _settle(key, future))
+        _details_cache[key] = future
+    row, _ = await asyncio.shield(future)
+    return row
+
+
+def _settle(key: tuple, future: asyncio.Future) -> None:
+    if _details_cache.get(key) is not future:
+        return
+    if future.cancelled() or future.exception():
+        _details_cache.pop(key)
+    else:
+        _details_cache.weigh(key, future.result()[1])
+
+
+def details_latency() -> float:
+    return _details_latency
+
+
+def _observe_latency(elapsed: float, n: float) -> None:
+    global _details_latency
+    if n:
+        _details_latency += DETAILS_LATENCY_ALPHA * (elapsed / n - _details_latency)
 
 
 def get_details(uri: str, res_fn: ResFn):
-    def _get(ids: list[int]) -> Data:
+    def _get(ids: Union[list[int], dict[int, Optional[str]]]) -> Data:
+        cursors = ids if isinstance(ids, dict) else dict.fromkeys(ids)
+        context = get_context()
+
         async def __get():
-            throttler = Throttler(rate_limit=DETAILS_API_REQ_PER_SEC, period=1)
-            async with _get_client() as client:
-                tasks = [
-                    asyncio.create_task(_get_one_id(client, throttler, uri, id, res_fn))
-                    for id in ids
-                ]
-                pages = await asyncio.gather(*tasks)
-                return [i for i in pages if i]
-
-        return asyncio.run(__get())
+            client = _get_client()
+            return [
+                row
+                async for row in _with_retries(
+                    lambda id: _get_one_id(client, uri, id, res_fn, cursors[id]),
+                    list(cursors),
+                    context.failed_ids,
+                    context.pending_ids,
+                    context.deadline,
+                )
+                if row
+            ]
+
+        start, pending = time.monotonic(), len(context.pending_ids)
+        hits = context.stats["fetch"]["cache_hits"]
+        rows = _run(__get())
+        elapsed = time.monotonic() - start
+        fetched = (
+            len(cursors)
+            - len(context.pending_ids)
+            + pending
+            - (context.stats["fetch"]["cache_hits"] - hits)
+        )
+        _observe_latency(elapsed, fetched)
+        record("fetch", details=fetched, details_seconds=elapsed)
+        return rows
 
     return _get
@@ -1,11 +1,9 @@
-from typing import Any
-from datetime import datetime, timedelta
+from typing import Any, Optional
+from datetime import date, datetime, timedelta
 
+from caresoft.repo import API_COUNT
 from db.bigquery import get_last_timestamp
 
-DATE_FORMAT = "%Y-%m-%d"
-API_COUNT = 500
-
 
 def dimension(*args):
     def _parse(*args):
@@ -17,10 +15,16 @@ def dimension(*args):
 def _listing_request_parser(start_key: str, end_key: str):
     def _parse(table, cursor_key):
         def __parse(body: dict[str, Any]) -> dict:
+            if "pages" in body:
+                return {
+                    **body["params"],
+                    "pages": body["pages"],
+                    "found": body.get("found"),
+                }
             _start = body.get("start")
             _end = body.get("end")
             if _start and _end:
-                start, end = [datetime.strptime(i, DATE_FORMAT) for i in [_start, _end]]
+                start, end = [datetime.fromisoformat(i) for i in [_start, _end]]
             else:
                 start = get_last_timestamp(table, cursor_key)
                 end = datetime.utcnow() + timedelta(hours=7)
@@ -41,7 +45,19 @@ updated = _listing_request_parser("updated_since", "updated_to")
 
 
 def details(*args):
-    def _parse(body: dict[str, list[int]]):
-        return body["ids"]
+    def _parse(body: dict[str, list]) -> dict[int, Optional[str]]:
+        if body.get("cursors"):
+            return dict(zip(body["ids"], body["cursors"]))
+        return dict.fromkeys(body["ids"])
+
+    return _parse
+
+
+def archived(*args):
+    def _parse(body: dict[str, Any]) -> tuple[Optional[date], Optional[date]]:
+        return tuple(  # type: ignore
+            date.fromisoformat(body[i][:10]) if body.get(i) else None
+            for i in ["start", "end"]
+        )
 
     return _parse
@@ -0,0 +1,92 @@
+from typing import Any, Iterable, Iterator, Optional, TypeVar
+from contextlib import contextmanager
+from importlib.util import find_spec
+import json
+import threading
+import time
+
+from caresoft.context import RunContext, get_context
+
+T = TypeVar("T")
+
+
+def _switch(context: RunContext, stage: Optional[str]) -> Optional[str]:
+    thread, now, cpu = threading.get_ident(), time.perf_counter(), time.thread_time()
+    previous, since, cpu_since = context.stages.get(thread, (None, now, cpu))
+    if previous:
+        stats = context.stats[previous]
+        stats["seconds"] += now - since
+        stats["cpu_seconds"] += cpu - cpu_since
+    context.stages[thread] = (stage, now, cpu)
+    return previous
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """Charge the time spent inside to `stage`, excluding nested stages.
+
+    Stages are tracked per thread, so overlapping workers each account for
+    their own time."""
+    context = get_context()
+    previous = _switch(context, stage)
+    try:
+        yield
+    finally:
+        _switch(context, previous)
+
+
+def timed_iter(stage: str, iterable: Iterable[T]) -> Iterator[T]:
+    iterator = iter(iterable)
+    while True:
+        with timed(stage):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def record(stage: str, **values: float) -> None:
+    stats = get_context().stats[stage]
+    for key, value in values.items():
+        stats[key] += value
+
+
+def _export(name: str, context: RunContext, spans: list[dict[str, Any]]) -> None:
+    from opentelemetry import trace
+
+    tracer = trace.get_tracer("caresoft")
+    root = tracer.start_span(name, start_time=context.started)
+    with trace.use_span(root, end_on_exit=True):
+        start = context.started
+        for span in spans:
+            end = start + int(span.get("seconds", 0) * 1e9)
+            tracer.start_span(
+                f"{name}.{span['stage']}",
+                start_time=start,
+                attributes=span,
+            ).end(end_time=end)
+            start = end
+
+
+def emit(name: str, context: RunContext) -> list[dict[str, Any]]:
+    """Log one JSON span per stage of the run, and export them to
+    OpenTelemetry when it is installed. Stage times are accumulated over all
+    streamed chunks, so exported spans are laid out back to back."""
+    spans = [
+        {"pipeline": name, "stage": stage, **stats}
+        for stage, stats in context.stats.items()
+    ]
+    for span in spans:
+        print(
+            json.dumps(
+                {
+                    "severity": "INFO",
+                    "message": f"{name}.{span['stage']}",
+                    **span,
+                }
+            )
+        )
+    if find_spec("opentelemetry"):
+        _export(name, context, spans)
+    return spans
@@ -0,0 +1,59 @@
+from typing import Any, Hashable, Optional
+from collections import OrderedDict
+import time
+
+
+class TTLCache:
+    """LRU-bounded mapping whose entries expire `ttl` seconds after insertion.
+
+    Entries can be given a weight after insertion (`weigh`); least recently
+    used entries are evicted while the total exceeds `maxweight`.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, maxweight: Optional[int] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxweight = maxweight
+        self.weight = 0
+        self._data: OrderedDict[Hashable, tuple[float, Any, int]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires, value, _ = item
+        if expires < time.monotonic():
+            self.pop(key)
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def __setitem__(self, key: Hashable, value: Any) -> None:
+        self.pop(key)
+        self._data[key] = (time.monotonic() + self.ttl, value, 0)
+        while len(self._data) > self.maxsize:
+            self._popitem()
+
+    def weigh(self, key: Hashable, weight: int) -> None:
+        item = self._data.get(key)
+        if item is None:
+            return
+        expires, value, previous = item
+        self._data[key] = (expires, value, weight)
+        self.weight += weight - previous
+        while self.maxweight is not None and self.weight > self.maxweight:
+            self._popitem()
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.pop(key, None)
+        if item is None:
+            return default
+        self.weight -= item[2]
+        return item[1]
+
+    def _popitem(self) -> None:
+        _, (_, _, weight) = self._data.popitem(last=False)
+        self.weight -= weight
@@ -1,60 +1,388 @@
-from typing import Optional
-from datetime import datetime
+from typing import IO, Iterable, Iterator, Optional, Sequence
+from datetime import datetime, timedelta
+from functools import lru_cache
+import gzip
+import json
+import tempfile
+import uuid
 
 from google.cloud import bigquery
+from google.api_core.exceptions import NotFound
 
 DATASET = "Caresoft"
-client = bigquery.Client()
+WATERMARK_TABLE = "_Watermarks"
+WATERMARK_DDL = f"""
+    CREATE TABLE IF NOT EXISTS {DATASET}.{WATERMARK_TABLE} (
+        pipeline STRING NOT NULL,
+        cursor TIMESTAMP,
+        latency FLOAT64,
+        updated_at TIMESTAMP
+    );
+
+    ALTER TABLE {DATASET}.{WATERMARK_TABLE}
+    ADD COLUMN IF NOT EXISTS latency FLOAT64;
+"""
+PARTITION_BOUND = "partition_bound"
+STAGE_EXPIRATION = timedelta(hours=1)
+LOAD_SPOOL_SIZE = 16 * 1024 * 1024
+LOAD_FILE_SIZE = 128 * 1024 * 1024
+LOAD_FILE_ROWS = 25000
+
+
+@lru_cache(maxsize=1)
+def get_client() -> bigquery.Client:
+    return bigquery.Client()
+
+
+def bootstrap() -> None:
+    """Create the watermark table, or add the columns older deploys lack.
+    Run once per deploy through `python -m db.migrate`, not per task."""
+    get_client().query(WATERMARK_DDL).result()
+
+
+def _get_watermarks() -> dict[str, bigquery.Row]:
+    try:
+        rows = get_client().list_rows(f"{DATASET}.{WATERMARK_TABLE}")
+        return {row["pipeline"]: row for row in rows}
+    except NotFound:
+        return {}
+
+
+def _get_watermark(table: str) -> Optional[datetime]:
+    row = _get_watermarks().get(table)
+    return row["cursor"] if row else None
+
+
+def get_latency(table: str) -> Optional[float]:
+    row = _get_watermarks().get(table)
+    return row.get("latency") if row else None
 
 
 def get_last_timestamp(table: str, cursor_key: str) -> datetime:
-    rows = client.query(
-        f"SELECT MAX({cursor_key}) AS incre FROM {DATASET}.{table}"
-    ).result()
+    watermark = _get_watermark(table)
+    if watermark:
+        return watermark
+
+    rows = (
+        get_client()
+        .query(f"SELECT MAX({cursor_key}) AS incre FROM {DATASET}.{table}")
+        .result()
+    )
     return [row for row in rows][0]["incre"]
 
 
+def get_cursors(
+    table: str,
+    id_key: str,
+    cursor_key: str,
+    ids: list[int],
+) -> dict[int, datetime]:
+    try:
+        rows = (
+            get_client()
+            .query(
+                f"""
+            SELECT {id_key} AS id, MAX({cursor_key}) AS cursor
+            FROM {DATASET}.{table}
+            WHERE {id_key} IN UNNEST(@ids)
+            GROUP BY 1
+            """,
+                job_config=bigquery.QueryJobConfig(
+                    query_parameters=[bigquery.ArrayQueryParameter("ids", "INT64", ids)]
+                ),
+            )
+            .result()
+        )
+        return {row["id"]: row["cursor"] for row in rows}
+    except NotFound:
+        return {}
+
+
+def _layout(partition_key: Optional[str], cluster_keys: Sequence[str]) -> str:
+    return "\n".join(
+        [
+            *([f"PARTITION BY DATE({partition_key})"] if partition_key else []),
+            *([f"CLUSTER BY {', '.join(cluster_keys)}"] if cluster_keys else []),
+        ]
+    )
+
+
+def _current_layout(table: bigquery.Table) -> tuple[Optional[str], tuple[str, ...]]:
+    partitioning = table.time_partitioning
+    return (
+        partitioning.field if partitioning else None,
+        tuple(table.clustering_fields or ()),
+    )
+
+
+def _migration(
+    table: str,
+    partition_key: Optional[str],
+    cluster_keys: Sequence[str],
+    suffix: str,
+) -> str:
+    migrated = f"{table}__migrate_{suffix}"
+    return f"""
+        CREATE TABLE {DATASET}.{migrated}
+        {_layout(partition_key, cluster_keys)}
+        AS SELECT * FROM {DATASET}.{table};
+
+        DROP TABLE {DATASET}.{table};
+
+        ALTER TABLE {DATASET}.{migrated} RENAME TO {table};
+        """
+
+
+def migrate_layout(
+    table: str,
+    partition_key: Optional[str],
+    cluster_keys: Sequence[str],
+) -> bool:
+    """Rebuild `table` with the given partitioning and clustering if it was
+    created with a different layout. BigQuery cannot change the partitioning
+    of a table in place, so rows are copied into a new table that is then
+    renamed over the old one. Loads into `table` must be paused meanwhile."""
+    try:
+        existing = get_client().get_table(f"{DATASET}.{table}")
+    except NotFound:
+        return False
+    if _current_layout(existing) == (partition_key, tuple(cluster_keys)):
+        return False
+    get_client().query(
+        _migration(table, partition_key, cluster_keys, uuid.uuid4().hex)
+    ).result()
+    return True
+
+
+def _open() -> tuple[IO[bytes], gzip.GzipFile]:
+    buffer = tempfile.SpooledTemporaryFile(max_size=LOAD_SPOOL_SIZE)
+    return buffer, gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=1)
+
+
+def _dump(chunks: Iterable[list[dict]]) -> Iterator[IO[bytes]]:
+    buffer, file = _open()
+    rows_written, files = 0, 0
+    for rows in chunks:
+        file.write("".join(f"{json.dumps(row)}\n" for row in rows).encode())
+        rows_written += len(rows)
+        if buffer.tell() >= LOAD_FILE_SIZE or rows_written >= LOAD_FILE_ROWS:
+            file.close()
+            yield buffer
+            buffer.close()
+            buffer, file = _open()
+            rows_written, files = 0, files + 1
+
+    file.close()
+    if rows_written or not files:
+        yield buffer
+    buffer.close()
+
+
+def _load(
+    table: str,
+    schema: list[dict],
+    chunks: Iterable[list[dict]],
+    write_disposition: str,
+    partition_key: Optional[str] = None,
+    cluster_keys: Sequence[str] = (),
+) -> int:
+    jobs: list[bigquery.LoadJob] = []
+    for i, file in enumerate(_dump(chunks)):
+        if i == 1 and write_disposition == "WRITE_TRUNCATE":
+            jobs[0].result()
+        jobs.append(
+            get_client().load_table_from_file(
+                file,
+                f"{DATASET}.{table}",
+                rewind=True,
+                job_config=bigquery.LoadJobConfig(
+                    schema=schema,
+                    source_format="NEWLINE_DELIMITED_JSON",
+                    create_disposition="CREATE_IF_NEEDED",
+                    write_disposition="WRITE_APPEND" if i else write_disposition,
+                    time_partitioning=bigquery.TimePartitioning(field=partition_key)
+                    if partition_key
+                    else None,
+                    clustering_fields=list(cluster_keys) or None,
+                ),
+            )
+        )
+    for job in jobs:
+        job.result()
+    return sum(job.output_rows or 0 for job in jobs)
+
+
 def load(
     table: str,
     schema: list[dict],
     id_key: Optional[str],
     cursor_key: Optional[str],
-    rows: list[dict],
+    chunks: Iterable[list[dict]],
+    watermark: bool = False,
+    partition_key: Optional[str] = None,
+    cluster_keys: Sequence[str] = (),
+    sink: str = "load",
 ) -> int:
-    output_rows = (
-        client.load_table_from_json(
-            rows,
-            f"{DATASET}.{table}",
-            job_config=bigquery.LoadJobConfig(
-                schema=schema,
-                create_disposition="CREATE_IF_NEEDED",
-                write_disposition="WRITE_APPEND" if id_key else "WRITE_TRUNCATE",
-            ),
+    if not (id_key and cursor_key):
+        if sink != "load":
+            raise ValueError(f"{table}: sink {sink} needs id_key and cursor_key")
+        return _load(
+            table,
+            schema,
+            chunks,
+            "WRITE_APPEND" if id_key else "WRITE_TRUNCATE",
+            partition_key,
+            cluster_keys,
         )
-        .result()
-        .output_rows
-    )
 
-    if id_key and cursor_key:
-        _update(table, id_key, cursor_key)
+    stage = f"{table}__stage_{uuid.uuid4().hex}"
+    stage_table = bigquery.Table(f"{get_client().project}.{DATASET}.{stage}", schema)
+    stage_table.expires = datetime.utcnow() + STAGE_EXPIRATION
+    get_client().create_table(stage_table)
+    try:
+        if sink == "storage_write":
+            from db.storage_write import write
+
+            output_rows = write(get_client().project, DATASET, stage, schema, chunks)
+        else:
+            output_rows = _load(stage, schema, chunks, "WRITE_APPEND")
+        if output_rows:
+            _create_table(table, schema, partition_key, cluster_keys)
+            get_client().query(
+                _transaction(
+                    _merge(table, stage, schema, id_key, cursor_key, partition_key),
+                    *([_watermark(table, stage, cursor_key)] if watermark else []),
+                    declare=_bound(stage, partition_key) if partition_key else "",
+                )
+            ).result()
+    finally:
+        get_client().delete_table(f"{DATASET}.{stage}", not_found_ok=True)
 
     return output_rows
 
 
-def _update(table: str, id_key: str, cursor_key: str) -> None:
-    client.query(
-        f"""
-        CREATE OR REPLACE TABLE {DATASET}.{table} AS
-        SELECT * EXCEPT (row_num)
-        FROM
-        (
+def _create_table(
+    table: str,
+    schema: list[dict],
+    partition_key: Optional[str],
+    cluster_keys: Sequence[str],
+) -> None:
+    target = bigquery.Table(f"{get_client().project}.{DATASET}.{table}", schema)
+    if partition_key:
+        target.time_partitioning = bigquery.TimePartitioning(field=partition_key)
+    target.clustering_fields = list(cluster_keys) or None
+    get_client().create_table(target, exists_ok=True)
+
+
+def _transaction(*statements: str, declare: str = "") -> str:
+    """Run `statements` as one multi-statement transaction, so a failed
+    statement leaves none of them applied. `declare` goes ahead of the
+    transaction, where BigQuery requires DECLARE statements."""
+    body = ";\n".join(statement.strip() for statement in statements)
+    return f"""
+        {declare}
+        BEGIN
+            BEGIN TRANSACTION;
+            {body};
+            COMMIT TRANSACTION;
+        EXCEPTION WHEN ERROR THEN
+            ROLLBACK TRANSACTION;
+            RAISE USING MESSAGE = @@error.message;
+        END;
+        """
+
+
+def _bound(stage: str, partition_key: str) -> str:
+    return f"""
+        DECLARE {PARTITION_BOUND} DEFAULT (
+            SELECT MIN({partition_key}) FROM {DATASET}.{stage}
+        );
+        """
+
+
+def _merge(
+    table: str,
+    stage: str,
+    schema: list[dict],
+    id_key: str,
+    cursor_key: str,
+    partition_key: Optional[str] = None,
+) -> str:
+    """MERGE the latest version of each staged row into `table`. With a
+    `partition_key`, which must never change for a row, the match is limited
+    to partitions from the earliest staged one, declared by `_bound` as a
+    constant so BigQuery prunes the target instead of scanning it."""
+    fields = [field["name"] for field in schema]
+    prune = (
+        f"AND (T.{partition_key} >= {PARTITION_BOUND} OR T.{partition_key} IS NULL)"
+        if partition_key
+        else ""
+    )
+    return f"""
+        MERGE {DATASET}.{table} T
+        USING (
+            SELECT * FROM {DATASET}.{stage}
+            WHERE TRUE
+            QUALIFY ROW_NUMBER() OVER (
+                PARTITION BY {id_key}
+                ORDER BY {cursor_key} DESC
+            ) = 1
+        ) S
+        ON T.{id_key} = S.{id_key}
+        {prune}
+        WHEN MATCHED AND (
+            T.{cursor_key} IS NULL OR S.{cursor_key} >= T.{cursor_key}
+        ) THEN
+            UPDATE SET {", ".join(f"{field} = S.{field}" for field in fields)}
+        WHEN NOT MATCHED THEN
+            INSERT ({", ".join(fields)})
+            VALUES ({", ".join(f"S.{field}" for field in fields)})
+        """
+
+
+def _watermark(table: str, stage: str, cursor_key: str) -> str:
+    return f"""
+        MERGE {DATASET}.{WATERMARK_TABLE} T
+        USING (
             SELECT
-                *,
-                ROW_NUMBER() over (
-                    PARTITION BY {id_key}
-                    ORDER BY {cursor_key} DESC
-                ) AS row_num
-            FROM {DATASET}.{table}
-        ) WHERE row_num = 1
+                "{table}" AS pipeline,
+                MAX({cursor_key}) AS cursor
+            FROM {DATASET}.{stage}
+        ) S
+        ON T.pipeline = S.pipeline
+        WHEN MATCHED THEN
+            UPDATE SET
+                cursor = GREATEST(
+                    IFNULL(T.cursor, S.cursor),
+                    IFNULL(S.cursor, T.cursor)
+                ),
+                updated_at = CURRENT_TIMESTAMP()
+        WHEN NOT MATCHED THEN
+            INSERT (pipeline, cursor, updated_at)
+            VALUES (S.pipeline, S.cursor, CURRENT_TIMESTAMP())
         """
+
+
+def update_latency(table: str, latency: float, alpha: float) -> None:
+    """Fold a details run's per-ID latency into the EWMA kept next to the
+    watermarks, so the task fan-out on any instance can size its batches."""
+    get_client().query(
+        f"""
+        MERGE {DATASET}.{WATERMARK_TABLE} T
+        USING (SELECT "{table}" AS pipeline, @latency AS latency) S
+        ON T.pipeline = S.pipeline
+        WHEN MATCHED THEN
+            UPDATE SET
+                latency = IFNULL(T.latency + @alpha * (S.latency - T.latency), S.latency),
+                updated_at = CURRENT_TIMESTAMP()
+        WHEN NOT MATCHED THEN
+            INSERT (pipeline, latency, updated_at)
+            VALUES (S.pipeline, S.latency, CURRENT_TIMESTAMP())
+        """,
+        job_config=bigquery.QueryJobConfig(
+            query_parameters=[
+                bigquery.ScalarQueryParameter("latency", "FLOAT64", latency),
+                bigquery.ScalarQueryParameter("alpha", "FLOAT64", alpha),
+            ]
+        ),
     ).result()
@@ -0,0 +1,28 @@
+"""One-off migration run after each deploy: creates or upgrades the watermark
+table, then moves existing tables to the partitioning and clustering declared
+on their Pipeline. Pause the task queues before running it:
+
+    python -m db.migrate [table ...]
+"""
+import sys
+
+from caresoft.pipeline import pipelines, details_pipelines
+from db.bigquery import bootstrap, migrate_layout
+
+
+def main(tables: list[str]) -> dict[str, bool]:
+    bootstrap()
+    _pipelines = pipelines | details_pipelines
+    return {
+        table: migrate_layout(
+            table,
+            _pipelines[table].partition_key,
+            _pipelines[table].cluster_keys,
+        )
+        for table in tables or _pipelines
+        if _pipelines[table].partition_key or _pipelines[table].cluster_keys
+    }
+
+
+if __name__ == "__main__":
+    print(main(sys.argv[1:]))
@@ -0,0 +1,208 @@
+from typing import Any, Callable, Iterable, Iterator
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+import json
+
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+from google.cloud.bigquery_storage_v1 import BigQueryWriteClient, types, writer
+
+APPEND_ROWS_SIZE = 8 * 1024 * 1024
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+BOOLS = {"true": True, "false": False, "1": True, "0": False}
+FieldType = descriptor_pb2.FieldDescriptorProto
+TYPES = {
+    "INTEGER": FieldType.TYPE_INT64,
+    "INT64": FieldType.TYPE_INT64,
+    "FLOAT": FieldType.TYPE_DOUBLE,
+    "FLOAT64": FieldType.TYPE_DOUBLE,
+    "BOOLEAN": FieldType.TYPE_BOOL,
+    "BOOL": FieldType.TYPE_BOOL,
+    "TIMESTAMP": FieldType.TYPE_INT64,
+}
+
+
+@lru_cache(maxsize=1)
+def get_write_client() -> BigQueryWriteClient:
+    return BigQueryWriteClient()
+
+
+def _descriptor(schema: list[dict], name: str) -> descriptor_pb2.DescriptorProto:
+    proto = descriptor_pb2.DescriptorProto(name=name)
+    for number, field in enumerate(schema, 1):
+        type_, mode = field["type"].upper(), field.get("mode", "").upper()
+        field_proto = proto.field.add(
+            name=field["name"],
+            number=number,
+            label=FieldType.LABEL_REPEATED
+            if mode == "REPEATED"
+            else FieldType.LABEL_OPTIONAL,
+        )
+        if type_ in ("RECORD", "STRUCT"):
+            nested = _descriptor(field["fields"], f"Field{number}")
+            proto.nested_type.append(nested)
+            field_proto.type = FieldType.TYPE_MESSAGE
+            field_proto.type_name = nested.name
+        else:
+            field_proto.type = TYPES.get(type_, FieldType.TYPE_STRING)
+    return proto
+
+
+def _timestamp(value: Any) -> int:
+    timestamp = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    if not timestamp.tzinfo:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return (timestamp - EPOCH) // timedelta(microseconds=1)
+
+
+def _int(value: Any) -> int:
+    if isinstance(value, float) and not value.is_integer():
+        raise ValueError(f"{value!r} is not integral")
+    return int(value)
+
+
+def _bool(value: Any) -> bool:
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (str, int)) and str(value).lower() in BOOLS:
+        return BOOLS[str(value).lower()]
+    raise ValueError(f"{value!r} is not a boolean")
+
+
+def _string(value: Any) -> str:
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list, bool)):
+        return json.dumps(value)
+    return str(value)
+
+
+def _converter(schema: list[dict]) -> Callable[[dict], dict]:
+    """Build a function converting a row to protobuf field values, coercing
+    like a JSON load job would and raising ValueError where one would fail
+    rather than writing a silently different value."""
+
+    def _scalar(type_: str) -> Callable[[Any], Any]:
+        if type_ == "TIMESTAMP":
+            return _timestamp
+        if TYPES.get(type_) == FieldType.TYPE_INT64:
+            return _int
+        if TYPES.get(type_) == FieldType.TYPE_DOUBLE:
+            return float
+        if TYPES.get(type_) == FieldType.TYPE_BOOL:
+            return _bool
+        return _string
+
+    fields = []
+    for field in schema:
+        type_, mode = field["type"].upper(), field.get("mode", "").upper()
+        convert = (
+            _converter(field["fields"])
+            if type_ in ("RECORD", "STRUCT")
+            else _scalar(type_)
+        )
+        fields.append((field["name"], convert, mode == "REPEATED"))
+
+    def _convert(row: dict) -> dict:
+        message = {}
+        for name, convert, repeated in fields:
+            value = row.get(name)
+            if value is None or value == {}:
+                continue
+            try:
+                message[name] = (
+                    [convert(i) for i in value if i is not None]
+                    if repeated
+                    else convert(value)
+                )
+            except (TypeError, ValueError) as e:
+                raise ValueError(f"{name}: {e}") from e
+        return message
+
+    return _convert
+
+
+def _serialize(schema: list[dict], chunks: Iterable[list[dict]]):
+    descriptor = _descriptor(schema, "Row")
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(
+        descriptor_pb2.FileDescriptorProto(
+            name="caresoft_row.proto",
+            package="caresoft",
+            message_type=[descriptor],
+        )
+    )
+    message_descriptor = pool.FindMessageTypeByName("caresoft.Row")
+    if hasattr(message_factory, "GetMessageClass"):
+        message_cls = message_factory.GetMessageClass(message_descriptor)
+    else:
+        message_cls = message_factory.MessageFactory(pool).GetPrototype(
+            message_descriptor
+        )
+    convert = _converter(schema)
+
+    def _batches() -> Iterator[list[bytes]]:
+        batch: list[bytes] = []
+        size = 0
+        for rows in chunks:
+            for row in rows:
+                serialized = message_cls(**convert(row)).SerializeToString()
+                if size + len(serialized) > APPEND_ROWS_SIZE and batch:
+                    yield batch
+                    batch, size = [], 0
+                batch.append(serialized)
+                size += len(serialized)
+        if batch:
+            yield batch
+
+    return descriptor, _batches()
+
+
+def write(project: str, dataset: str, table: str, schema: list[dict], chunks) -> int:
+    """Append rows through a PENDING write stream and commit them atomically."""
+    client = get_write_client()
+    parent = client.table_path(project, dataset, table)
+    descriptor, batches = _serialize(schema, chunks)
+
+    stream = client.create_write_stream(
+        parent=parent,
+        write_stream=types.WriteStream(type_=types.WriteStream.Type.PENDING),
+    )
+    append_rows = writer.AppendRowsStream(
+        client,
+        types.AppendRowsRequest(
+            write_stream=stream.name,
+            proto_rows=types.AppendRowsRequest.ProtoData(
+                writer_schema=types.ProtoSchema(proto_descriptor=descriptor),
+            ),
+        ),
+    )
+    offset, futures = 0, []
+    try:
+        for batch in batches:
+            futures.append(
+                append_rows.send(
+                    types.AppendRowsRequest(
+                        offset=offset,
+                        proto_rows=types.AppendRowsRequest.ProtoData(
+                            rows=types.ProtoRows(serialized_rows=batch),
+                        ),
+                    )
+                )
+            )
+            offset += len(batch)
+        for future in futures:
+            future.result()
+    finally:
+        append_rows.close()
+
+    client.finalize_write_stream(name=stream.name)
+    response = client.batch_commit_write_streams(
+        types.BatchCommitWriteStreamsRequest(
+            parent=parent,
+            write_streams=[stream.name],
+        )
+    )
+    if response.stream_errors:
+        raise RuntimeError(response.stream_errors)
+    return offset
@@ -1,7 +1,10 @@
 from typing import Any
+import hmac
+import os
 
 from caresoft.caresoft_controller import caresoft_controller
 from tasks.tasks_service import create_cron_tasks_service
+from webhook.webhook_service import webhook_service
 
 
 def main(request):
@@ -10,10 +13,28 @@ def main(request):
 
     if "tasks" in data:
         response = create_cron_tasks_service(data)
-    elif "table" in data:
+    elif "table" in data or "tables" in data:
         response = caresoft_controller(data)
     else:
         raise ValueError(data)
 
     print(response)
     return response
+
+
+def webhook(request):
+    secret = os.getenv("WEBHOOK_TOKEN")
+    token = request.headers.get("X-Webhook-Token", "")
+    if not secret or not hmac.compare_digest(token.encode(), secret.encode()):
+        return {"error": "Forbidden"}, 403
+
+    data = request.get_json(silent=True)
+    print(data)
+
+    try:
+        response = webhook_service(data)
+    except ValueError as e:
+        return {"error": f"Bad Request: {e}"}, 400
+
+    print(response)
+    return response
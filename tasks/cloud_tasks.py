@@ -1,4 +1,6 @@
 from typing import Callable, Any
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import os
 import json
 import uuid
@@ -6,46 +8,67 @@ import uuid
 from google.cloud import tasks_v2
 from google import auth
 
+TASKS_CONCURRENCY = 16
 
-_, PROJECT_ID = auth.default()
+
+@lru_cache(maxsize=1)
+def _get_project_id() -> str:
+    _, project_id = auth.default()
+    if project_id is None:
+        raise EnvironmentError("No Google Cloud project in the default credentials")
+    return project_id
+
+
+@lru_cache(maxsize=1)
+def _get_client() -> tasks_v2.CloudTasksClient:
+    return tasks_v2.CloudTasksClient()
 
 
 def create_tasks(
     queue: str,
     payloads: list[dict[str, Any]],
     name_fn: Callable[[dict[str, Any]], str],
-) -> int:
-    with tasks_v2.CloudTasksClient() as client:
-        task_path = (PROJECT_ID, "asia-southeast2", queue)
-        parent = client.queue_path(*task_path)
-        tasks = [
-            {
-                "name": client.task_path(
-                    *task_path,
-                    task=f"{name_fn(payload)}-{uuid.uuid4()}",
-                ),
-                "http_request": {
-                    "http_method": tasks_v2.HttpMethod.POST,
-                    "url": os.getenv("PUBLIC_URL"),
-                    "oidc_token": {
-                        "service_account_email": os.getenv("GCP_SA"),
-                    },
-                    "headers": {
-                        "Content-type": "application/json",
-                    },
-                    "body": json.dumps(payload).encode(),
+) -> dict[str, Any]:
+    client = _get_client()
+    task_path = (_get_project_id(), "asia-southeast2", queue)
+    parent = client.queue_path(*task_path)
+    tasks = [
+        {
+            "name": client.task_path(
+                *task_path,
+                task=f"{name_fn(payload)}-{uuid.uuid4()}",
+            ),
+            "http_request": {
+                "http_method": tasks_v2.HttpMethod.POST,
+                "url": os.getenv("PUBLIC_URL"),
+                "oidc_token": {
+                    "service_account_email": os.getenv("GCP_SA"),
+                },
+                "headers": {
+                    "Content-type": "application/json",
+                },
+                "body": json.dumps(payload).encode(),
+            },
+        }
+        for payload in payloads
+    ]
+    with ThreadPoolExecutor(max_workers=TASKS_CONCURRENCY) as executor:
+        futures = [
+            executor.submit(
+                client.create_task,
+                request={
+                    "parent": parent,
+                    "task": task,
                 },
-            }
-            for payload in payloads
+            )
+            for task in tasks
         ]
-        return len(
-            [
-                client.create_task(
-                    request={
-                        "parent": parent,
-                        "task": task,
-                    }
-                )
-                for task in tasks
-            ]
-        )
+    errors = [
+        {"task": task["name"], "error": str(future.exception())}
+        for task, future in zip(tasks, futures)
+        if future.exception()
+    ]
+    return {
+        "tasks": len(tasks) - len(errors),
+        **({"errors": errors} if errors else {}),
+    }
@@ -1,39 +1,205 @@
-from typing import Callable, Any
+from typing import Callable, Any, Optional
+from datetime import datetime, timezone
+import math
 
-from caresoft.pipeline import pipelines
-from caresoft.repo import DETAILS_LIMIT, Data
+from caresoft.context import DEADLINE_MARGIN, FUNCTION_TIMEOUT, RunContext
+from caresoft.pipeline import dimension_pipelines, listing_pipelines
+from caresoft.pipeline.interface import Pipeline
+from caresoft.repo import (
+    BACKFILL_LIMIT,
+    DETAILS_LIMIT,
+    DETAILS_MIN_LIMIT,
+    Data,
+    details_latency,
+)
 from tasks.cloud_tasks import create_tasks
+from db.bigquery import get_cursors, get_latency
 
+TASK_MAX_RETRIES = 3
+DETAILS_BUDGET_RATIO = 0.8
 
-def create_cron_tasks_service(body: dict[str, str]) -> dict[str, int]:
+
+def _parse_timestamp(value: Any) -> Optional[datetime]:
+    try:
+        timestamp = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return timestamp if timestamp.tzinfo else timestamp.replace(tzinfo=timezone.utc)
+
+
+def _plan_windows(
+    pipeline: Pipeline,
+    body: dict[str, str],
+) -> list[dict[str, Optional[str]]]:
+    if not (pipeline.count and body.get("start") and body.get("end")):
+        return [{"start": body.get("start"), "end": body.get("end")}]
+
+    num_found = pipeline.count(
+        pipeline.params_fn(pipeline.name, pipeline.cursor_key)(body)
+    )
+    start, end = [datetime.fromisoformat(body[i]) for i in ["start", "end"]]
+    windows = max(math.ceil(num_found / BACKFILL_LIMIT), 1)
+    bounds = [
+        (start + (end - start) * i / windows).isoformat(timespec="seconds")
+        for i in range(windows)
+    ] + [end.isoformat(timespec="seconds")]
+    return [{"start": i, "end": j} for i, j in zip(bounds[:-1], bounds[1:])]
+
+
+def create_cron_tasks_service(body: dict[str, str]) -> dict[str, Any]:
+    return create_tasks(
+        "caresoft",
+        [{"tables": list(dimension_pipelines.keys())}]
+        + [
+            {"table": table, **window}
+            for table, pipeline in listing_pipelines.items()
+            for window in _plan_windows(pipeline, body)
+        ],
+        lambda x: x.get("table", "Dimensions"),
+    )
+
+
+def _changed_ids(
+    table: str,
+    id_key: str,
+    cursor_key: str,
+    rows: Data,
+) -> dict[int, Optional[datetime]]:
+    latest: dict[int, Optional[datetime]] = {}
+    for row in rows:
+        cursor = _parse_timestamp(row[cursor_key])
+        previous = latest.get(row[id_key], cursor)
+        latest[row[id_key]] = max(cursor, previous) if cursor and previous else None
+
+    stored = get_cursors(table, id_key, cursor_key, list(latest.keys()))
     return {
-        "tasks": create_tasks(
-            "caresoft",
-            [
+        id: cursor
+        for id, cursor in latest.items()
+        if not cursor or not stored.get(id) or cursor > stored[id]
+    }
+
+
+def _details_limit(table: str) -> int:
+    """IDs per details task that fit the time budget at `table`'s persisted
+    per-ID latency, or this instance's estimate before one is persisted."""
+    budget = (FUNCTION_TIMEOUT - DEADLINE_MARGIN) * DETAILS_BUDGET_RATIO
+    latency = get_latency(table) or details_latency()
+    return max(DETAILS_MIN_LIMIT, min(DETAILS_LIMIT, int(budget / latency)))
+
+
+def create_details_tasks_service(
+    table: str,
+    id_key: str,
+    cursor_key: str,
+    rows: Data,
+):
+    changed = _changed_ids(table, id_key, cursor_key, rows)
+    ids = list(changed.keys())
+    limit = _details_limit(table) if ids else DETAILS_LIMIT
+    return create_tasks(
+        "caresoft-details",
+        [
+            {
+                "table": table,
+                "ids": ids[i : i + limit],
+                "cursors": [
+                    changed[id].isoformat() if changed[id] else None  # type: ignore
+                    for id in ids[i : i + limit]
+                ],
+            }
+            for i in range(0, len(ids), limit)
+        ],
+        lambda x: x["table"],
+    )
+
+
+def _retry_payloads(
+    table: str,
+    params: Any,
+    pages: list[int],
+    ids: list[int],
+    retry: int,
+    found: Optional[int] = None,
+) -> list[tuple[str, dict[str, Any]]]:
+    limit = _details_limit(table) if ids else DETAILS_LIMIT
+    payloads = [
+        (
+            "caresoft-details",
+            {
+                "table": table,
+                "ids": ids[i : i + limit],
+                "cursors": [params.get(id) for id in ids[i : i + limit]],
+                "retry": retry,
+            },
+        )
+        for i in range(0, len(ids), limit)
+    ]
+    if pages:
+        payloads.append(
+            (
+                "caresoft",
                 {
                     "table": table,
-                    "start": body.get("start"),
-                    "end": body.get("end"),
-                }
-                for table in pipelines.keys()
-            ],
-            lambda x: x["table"],
+                    "params": {
+                        k: v for k, v in params.items() if k not in ("pages", "found")
+                    },
+                    "pages": pages,
+                    "found": found,
+                    "retry": retry,
+                },
+            )
         )
-    }
+    return payloads
 
 
-def create_details_tasks_service(table: str, id_key: str, rows: Data):
-    ids = [id[id_key] for id in rows]
-    return {
-        "tasks": create_tasks(
-            "caresoft-details",
-            [
+def create_retry_tasks_service(
+    table: str,
+    body: dict[str, Any],
+    params: Any,
+    context: RunContext,
+) -> dict[str, Any]:
+    pages, ids = context.failed_pages, context.failed_ids
+    retry = body.get("retry", 0)
+    exhausted = bool(pages or ids) and retry >= TASK_MAX_RETRIES
+
+    payloads = _retry_payloads(
+        table,
+        params,
+        context.pending_pages,
+        context.pending_ids,
+        retry,
+        context.found,
+    )
+    if not exhausted:
+        payloads += _retry_payloads(table, params, pages, ids, retry + 1, context.found)
+
+    if context.pending_dates:
+        payloads.append(
+            (
+                "caresoft",
                 {
                     "table": table,
-                    "ids": ids[i : i + DETAILS_LIMIT],
-                }
-                for i in range(0, len(ids), DETAILS_LIMIT)
-            ],
-            lambda x: x["table"],
+                    "replay": True,
+                    "start": context.pending_dates[0],
+                    "end": context.pending_dates[-1],
+                    "retry": retry,
+                },
+            )
         )
+
+    queues: dict[str, list[dict[str, Any]]] = {}
+    for queue, payload in payloads:
+        queues.setdefault(queue, []).append(payload)
+    return {
+        **(
+            {
+                "retry_res": {
+                    queue: create_tasks(queue, payloads, lambda x: x["table"])
+                    for queue, payloads in queues.items()
+                }
+            }
+            if queues
+            else {}
+        ),
+        **({"failed": {"pages": pages, "ids": ids}} if exhausted else {}),
     }
@@ -0,0 +1,138 @@
+from typing import Any, Optional
+from collections import Counter
+import asyncio
+import json
+import random
+
+import httpx
+
+from caresoft.pipeline import pipelines, details_pipelines
+
+LISTING = {"calls": "Calls", "contacts": "Contacts", "tickets": "Tickets"}
+DETAILS = {"contacts": "ContactsDetails", "tickets": "TicketsDetails"}
+DIMENSIONS = {
+    "agents": ("Agents", "agents"),
+    "groups": ("Groups", "groups"),
+    "services": ("Services", "services"),
+    "contacts/custom_fields": ("ContactsCustomFields", "custom_fields"),
+    "tickets/custom_fields": ("TicketsCustomFields", "custom_fields"),
+}
+TEMPLATES = 256
+
+
+def _value(rng: random.Random, field: dict[str, Any]) -> Any:
+    type_, mode = field["type"].upper(), field.get("mode", "").upper()
+    if mode == "REPEATED":
+        return [
+            _value(rng, {**field, "mode": "NULLABLE"}) for _ in range(rng.randint(0, 4))
+        ]
+    if type_ == "RECORD":
+        return fake_row(rng, field["fields"])
+    if type_ == "INTEGER":
+        return rng.randint(0, 10**9)
+    if type_ == "TIMESTAMP":
+        return f"2022-06-{rng.randint(1, 28):02d} {rng.randint(0, 23):02d}:00:00"
+    return "".join(rng.choices("abcdefghijklmnopqrstuvwxyz ", k=rng.randint(4, 40)))
+
+
+def fake_row(rng: random.Random, schema: list[dict[str, Any]]) -> dict[str, Any]:
+    return {field["name"]: _value(rng, field) for field in schema}
+
+
+def fake_rows(table: str, n: int, seed: int = 0) -> list[dict[str, Any]]:
+    pipeline = (pipelines | details_pipelines)[table]
+    rng = random.Random(seed)
+    templates = [fake_row(rng, pipeline.schema) for _ in range(min(n, TEMPLATES))]
+    return [
+        {**templates[i % len(templates)], pipeline.id_key or "id": i} for i in range(n)
+    ]
+
+
+class FakeCaresoft:
+    """In-process Caresoft API served through httpx.MockTransport.
+
+    Supports listing paging (`page`/`count`, `numFound`), details by id and
+    dimension endpoints, plus injected latency, 429s (with `Retry-After`)
+    and 500s.
+    """
+
+    def __init__(
+        self,
+        rows: int = 200_000,
+        latency: float = 0,
+        throttle_rate: float = 0,
+        error_rate: float = 0,
+        retry_after: Optional[float] = None,
+        seed: int = 0,
+    ):
+        self.rows = rows
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.requests: Counter = Counter()
+        self._templates = {
+            table: fake_rows(table, TEMPLATES, seed)
+            for table in [*LISTING.values(), *DETAILS.values()]
+        }
+
+    def _row(self, table: str, id: int) -> dict[str, Any]:
+        pipeline = (pipelines | details_pipelines)[table]
+        templates = self._templates[table]
+        return {**templates[id % len(templates)], pipeline.id_key or "id": id}
+
+    def _listing(self, uri: str, params: httpx.QueryParams) -> dict[str, Any]:
+        page, count = int(params.get("page", 1)), int(params.get("count", 500))
+        return {
+            "numFound": self.rows,
+            uri: [
+                self._row(LISTING[uri], id)
+                for id in range((page - 1) * count, min(page * count, self.rows))
+            ],
+        }
+
+    def _response(self, path: str, params: httpx.QueryParams) -> httpx.Response:
+        if path in LISTING:
+            return httpx.Response(200, json=self._listing(path, params))
+        if path in DIMENSIONS:
+            table, key = DIMENSIONS[path]
+            schema = pipelines[table].schema
+            return httpx.Response(
+                200,
+                json={key: [fake_row(self.rng, schema) for _ in range(50)]},
+            )
+        resource, _, id = path.rpartition("/")
+        if resource in DETAILS and id.isdigit():
+            if int(id) >= self.rows:
+                return httpx.Response(404, json={})
+            return httpx.Response(
+                200,
+                json={resource[:-1]: self._row(DETAILS[resource], int(id))},
+            )
+        return httpx.Response(404, json={})
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path.split("/api/v1/", 1)[-1]
+        self.requests["total"] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.rng.random() < self.throttle_rate:
+            self.requests[429] += 1
+            return httpx.Response(
+                429,
+                headers={"Retry-After": str(self.retry_after)}
+                if self.retry_after is not None
+                else {},
+            )
+        if self.rng.random() < self.error_rate:
+            self.requests[500] += 1
+            return httpx.Response(500, content=json.dumps({"error": "injected"}))
+        self.requests[200] += 1
+        return self._response(path, request.url.params)
+
+    def client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            base_url="https://api.caresoft.vn/VUANEM/api/v1/",
+            transport=httpx.MockTransport(self),
+        )
@@ -0,0 +1,85 @@
+from typing import Any
+import os
+import tracemalloc
+
+import pytest
+
+from caresoft import repo
+from caresoft.pipeline import pipelines, listing_pipelines, details_pipelines
+from caresoft.rate_limiter import RateLimiter
+from test.fake_caresoft import FakeCaresoft, fake_rows
+
+BENCHMARK_ROWS = int(os.getenv("BENCHMARK_ROWS", 200_000))
+BENCHMARK_IDS = int(os.getenv("BENCHMARK_IDS", 5_000))
+BENCHMARK_REQ_PER_SEC = 1_000
+
+pytestmark = pytest.mark.benchmark
+
+FAULTS: tuple[tuple[str, dict[str, Any]], ...] = (
+    ("clean", {}),
+    ("faulty", {"throttle_rate": 0.05, "error_rate": 0.01, "retry_after": 0}),
+)
+
+
+@pytest.fixture(params=[f[1] for f in FAULTS], ids=[f[0] for f in FAULTS])
+def caresoft(request, monkeypatch):
+    fake = FakeCaresoft(rows=BENCHMARK_ROWS, **request.param)
+    monkeypatch.setattr(repo, "_client", fake.client())
+    for limiter in ["_listing_limiter", "_details_limiter"]:
+        monkeypatch.setattr(
+            repo,
+            limiter,
+            RateLimiter(BENCHMARK_REQ_PER_SEC, min_rate=BENCHMARK_REQ_PER_SEC),
+        )
+    return fake
+
+
+def run(benchmark, fn, *args) -> int:
+    rows = benchmark.pedantic(fn, args=args, rounds=1, iterations=1)
+
+    tracemalloc.start()
+    fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    benchmark.extra_info["rows"] = rows
+    benchmark.extra_info["rows_per_sec"] = rows / benchmark.stats.stats.mean
+    benchmark.extra_info["peak_memory_mb"] = peak / 1024 / 1024
+    return rows
+
+
+class TestBenchmark:
+    @pytest.mark.parametrize(
+        "pipeline",
+        argvalues=listing_pipelines.values(),
+        ids=listing_pipelines.keys(),
+    )
+    def test_listing(self, benchmark, caresoft, pipeline):
+        def _listing():
+            return sum(len(page) for page in pipeline.get({"count": repo.API_COUNT}))
+
+        assert run(benchmark, _listing) > 0
+
+    @pytest.mark.parametrize(
+        "pipeline",
+        argvalues=details_pipelines.values(),
+        ids=details_pipelines.keys(),
+    )
+    def test_details(self, benchmark, caresoft, pipeline):
+        def _details():
+            return len(pipeline.get(list(range(BENCHMARK_IDS))))
+
+        assert run(benchmark, _details) > 0
+
+    @pytest.mark.parametrize(
+        "pipeline",
+        argvalues=(pipelines | details_pipelines).values(),
+        ids=(pipelines | details_pipelines).keys(),
+    )
+    def test_transform(self, benchmark, pipeline):
+        rows = fake_rows(pipeline.name, BENCHMARK_ROWS)
+
+        def _transform():
+            return len(pipeline.transform(rows))
+
+        assert run(benchmark, _transform) == BENCHMARK_ROWS
@@ -1,8 +1,46 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from datetime import datetime, timezone
+import asyncio
+import dataclasses
+import gzip
+import subprocess
+import sys
+import time
+import uuid
+
+from google.cloud import bigquery
 import pytest
 
+import main
+from caresoft import archive, repo
+from caresoft.codec import dumps, loads
+from caresoft.context import DEADLINE_MARGIN, FUNCTION_TIMEOUT, run_context
 from caresoft.pipeline import dimension_pipelines, listing_pipelines, details_pipelines
-from caresoft.caresoft_service import pipeline_service
+from caresoft.pipeline.transform import compile_transform
+from caresoft import caresoft_controller as caresoft_controller_module
+from caresoft.caresoft_controller import caresoft_controller
+from caresoft.caresoft_service import _buffered, pipeline_service
+from caresoft.rate_limiter import RateLimiter
+from caresoft.telemetry import emit, timed
+from caresoft.request_parser import details
+from caresoft.ttl_cache import TTLCache
+from tasks import tasks_service
 from tasks.tasks_service import create_cron_tasks_service
+from db.bigquery import (
+    LOAD_FILE_ROWS,
+    _bound,
+    _current_layout,
+    _dump,
+    _merge,
+    _migration,
+    _transaction,
+    _watermark,
+)
+from db.storage_write import _converter, _serialize
+from test.fake_caresoft import FakeCaresoft, fake_rows
+from webhook.micro_batch import MicroBatch
+from webhook.webhook_service import _parse
 
 test_details_data = {
     "TicketsDetails": [
@@ -35,6 +73,8 @@ test_details_data = {
     ],
 }
 
+IMPORT_BUDGET = 2
+
 TIMEFRAME = (
     # ("auto", (None, None)),
     ("manual", ("2022-06-22", "2022-06-27")),
@@ -62,6 +102,22 @@ class TestCaresoft:
     def test_dimensions(self, pipeline):
         self.assert_pipelines(pipeline, {})
 
+    def test_dimensions_batch(self):
+        res = caresoft_controller({"tables": list(dimension_pipelines.keys())})
+        assert res.keys() == dimension_pipelines.keys()
+        assert all(i["output_rows"] >= 0 for i in res.values())
+
+    def test_dimensions_batch_isolated(self, monkeypatch):
+        def _service(pipeline, body):
+            if pipeline.name == "Groups":
+                raise ValueError(pipeline.name)
+            return {"table": pipeline.name, "output_rows": 1}
+
+        monkeypatch.setattr(caresoft_controller_module, "pipeline_service", _service)
+        res = caresoft_controller({"tables": list(dimension_pipelines.keys())})
+        assert res.pop("Groups") == {"error": "ValueError('Groups')"}
+        assert all(i["output_rows"] == 1 for i in res.values())
+
     @pytest.mark.parametrize(
         "pipeline",
         argvalues=listing_pipelines.values(),
@@ -88,7 +144,482 @@ class TestCaresoft:
         )
 
 
+class TestTransform:
+    def test_compile_transform(self):
+        transform = compile_transform(
+            [
+                {"name": "id", "type": "INTEGER"},
+                {"name": "organization", "type": "STRING"},
+                {
+                    "name": "assignee",
+                    "type": "RECORD",
+                    "fields": [{"name": "id", "type": "INTEGER"}],
+                },
+                {
+                    "name": "tags",
+                    "type": "record",
+                    "mode": "repeated",
+                    "fields": [{"name": "name", "type": "STRING"}],
+                },
+            ]
+        )
+        assert transform(
+            [
+                {"id": 1, "organization": {"id": 2}, "assignee": {"id": 3, "x": 4}},
+                {"id": 5, "tags": [{"name": "a", "x": "b"}]},
+            ]
+        ) == [
+            {"id": 1, "organization": '{"id": 2}', "assignee": {"id": 3}, "tags": []},
+            {"id": 5, "organization": None, "assignee": {}, "tags": [{"name": "a"}]},
+        ]
+
+
+def patch_caresoft(monkeypatch, fake: FakeCaresoft) -> FakeCaresoft:
+    monkeypatch.setattr(repo, "_client", fake.client())
+    monkeypatch.setattr(repo, "_listing_stats", {})
+    for limiter in ["_listing_limiter", "_details_limiter"]:
+        monkeypatch.setattr(repo, limiter, RateLimiter(1000, min_rate=1000))
+    return fake
+
+
+@pytest.fixture
+def faulty_caresoft(monkeypatch):
+    return patch_caresoft(
+        monkeypatch,
+        FakeCaresoft(rows=5000, error_rate=0.2, seed=1),
+    )
+
+
+@pytest.fixture
+def clean_caresoft(monkeypatch):
+    monkeypatch.setattr(repo, "_details_cache", TTLCache(100, 60))
+    return patch_caresoft(monkeypatch, FakeCaresoft(rows=5000))
+
+
+class TestRetry:
+    def test_listing(self, faulty_caresoft):
+        with run_context() as context:
+            ids = [
+                row["ticket_id"]
+                for page in listing_pipelines["Tickets"].get({"count": repo.API_COUNT})
+                for row in page
+            ]
+        assert len(ids) == len(set(ids))
+        assert len(ids) + len(context.failed_pages) * repo.API_COUNT == 5000
+        assert faulty_caresoft.requests[500] > 0
+
+    def test_details(self, faulty_caresoft):
+        with run_context() as context:
+            rows = details_pipelines["TicketsDetails"].get(list(range(4900, 5100)))
+        ids = {row["ticket_id"] for row in rows}
+        assert not ids & set(context.failed_ids)
+        assert ids | set(context.failed_ids) >= set(range(4900, 5000))
+        assert faulty_caresoft.requests[500] > 0
+
+
+class TestDetailsCache:
+    def test_dedupe(self, clean_caresoft):
+        rows = details_pipelines["TicketsDetails"].get(
+            details()({"ids": [1, 2, 2, 3, 1]})
+        )
+        assert sorted(row["ticket_id"] for row in rows) == [1, 2, 3]
+        assert clean_caresoft.requests["total"] == 3
+
+    def test_cache(self, clean_caresoft):
+        body = {
+            "ids": [1, 2, 3],
+            "cursors": ["2022-06-22T00:00:00", "2022-06-22T00:00:00", None],
+        }
+        with run_context() as context:
+            for cursors in [
+                body["cursors"],
+                body["cursors"][:1] + ["2022-06-23"] * 2,
+            ]:
+                details_pipelines["TicketsDetails"].get(
+                    details()({**body, "cursors": cursors})
+                )
+        assert clean_caresoft.requests["total"] == 5
+        assert context.stats["fetch"]["cache_hits"] == 1
+        assert context.stats["fetch"]["details"] == 5
+
+    def test_evict_on_error(self, clean_caresoft):
+        get = repo.get_details("tickets", lambda x: x["missing"])
+        for _ in range(2):
+            with pytest.raises(KeyError):
+                get({1: "2022-06-22T00:00:00"})
+        assert clean_caresoft.requests["total"] == 2
+        assert not len(repo._details_cache)
+
+    def test_max_weight(self):
+        cache = TTLCache(10, 60, maxweight=100)
+        for i in range(4):
+            cache[i] = i
+            cache.weigh(i, 40)
+        assert [cache.get(i) for i in range(4)] == [None, None, 2, 3]
+        assert cache.weight == 80
+
+
+class TestDeadline:
+    def test_listing(self, clean_caresoft, monkeypatch):
+        monkeypatch.setattr(clean_caresoft, "latency", 0.3)
+        monkeypatch.setattr(
+            repo,
+            "_listing_limiter",
+            RateLimiter(repo.LISTING_API_REQ_PER_SEC),
+        )
+        with run_context() as context:
+            context.deadline = time.monotonic() + 1
+            rows = sum(
+                len(page)
+                for page in listing_pipelines["Tickets"].get({"count": repo.API_COUNT})
+            )
+        assert context.pending_pages
+        assert rows + len(context.pending_pages) * repo.API_COUNT == 5000
+
+    def test_details(self, clean_caresoft, monkeypatch):
+        monkeypatch.setattr(clean_caresoft, "latency", 0.05)
+        with run_context() as context:
+            context.deadline = time.monotonic() + 0.5
+            rows = details_pipelines["TicketsDetails"].get(list(range(2000)))
+        assert context.pending_ids
+        assert len(rows) + len(context.pending_ids) == 2000
+        assert repo.details_latency() > 0
+
+
+class TestPaging:
+    def test_window(self):
+        in_flight = []
+
+        async def _fetch(key):
+            in_flight.append(None)
+            await asyncio.sleep(0.01)
+            in_flight.pop()
+            return [len(in_flight)]
+
+        async def _collect():
+            return [
+                i
+                async for i in repo._with_retries(_fetch, list(range(50)), [], window=4)
+            ]
+
+        assert max(sum(repo._run(_collect()), [])) < 4
+
+    def test_page_size(self, monkeypatch):
+        monkeypatch.setattr(repo, "_listing_stats", {})
+        monkeypatch.setattr(repo, "_listing_blocks", Counter())
+        assert [repo.page_size("tickets") for _ in range(3)] == [500, 250, 125]
+        repo._listing_stats.update(
+            {
+                ("tickets", 125): (125, 0.5),
+                ("tickets", 250): (250, 0.5),
+                ("tickets", 500): (0, 5),
+            }
+        )
+        sizes = [repo.page_size("tickets") for _ in range(repo.LISTING_EXPLORE_EVERY)]
+        assert sizes == [250] * (repo.LISTING_EXPLORE_EVERY - 1) + [500]
+
+    def test_listing(self, clean_caresoft):
+        ids = [
+            row["ticket_id"]
+            for page in listing_pipelines["Tickets"].get({"count": repo.API_COUNT})
+            for row in page
+        ]
+        assert sorted(ids) == list(range(5000))
+        assert clean_caresoft.requests["total"] > 10
+
+    def test_widen(self):
+        assert repo._widen([5, 6], 5000, 4000) == [3, 4, 5, 6]
+        assert repo._widen([9, 10], 5000, 4000) == [7, 8]
+        assert repo._widen([2], 1000, 1600) == [2, 3, 4]
+        assert repo._widen([2, 3], 1500, 1500) == [2, 3]
+
+    def test_continuation(self, clean_caresoft, monkeypatch):
+        monkeypatch.setattr(clean_caresoft, "rows", 4000)
+        with run_context() as context:
+            ids = [
+                row["ticket_id"]
+                for page in listing_pipelines["Tickets"].get(
+                    {"count": repo.API_COUNT, "pages": [5, 6], "found": 5000}
+                )
+                for row in page
+            ]
+        assert sorted(ids) == list(range(1000, 3000))
+        assert context.found == 4000
+
+
+class TestTelemetry:
+    def test_timed(self):
+        with run_context() as context:
+            with timed("load"):
+                time.sleep(0.1)
+                with timed("fetch"):
+                    time.sleep(0.2)
+        spans = {span["stage"]: span for span in emit("Tickets", context)}
+        assert 0.1 <= spans["load"]["seconds"] < 0.2
+        assert 0.2 <= spans["fetch"]["seconds"] < 0.3
+
+
+class TestBuffered:
+    def test_order(self):
+        assert list(_buffered(iter(range(100)), 2)) == list(range(100))
+
+    def test_error(self):
+        def _fail():
+            yield 1
+            raise ValueError
+
+        with pytest.raises(ValueError):
+            list(_buffered(_fail(), 2))
+
+    def test_close(self):
+        consumed = _buffered(iter(range(100)), 2)
+        assert next(consumed) == 0
+        consumed.close()
+
+
+class TestWebhook:
+    def test_parse(self):
+        assert _parse(
+            [{"ticket": {"ticket_id": 1}}, {"contact": {"id": 2}}, {"other": {}}]
+        ) == {"ticket": [{"ticket_id": 1}], "contact": [{"id": 2}]}
+
+    @pytest.mark.parametrize(
+        "body",
+        [None, "ticket", [1], [{"ticket": [1]}], {"other": {}}],
+    )
+    def test_parse_invalid(self, body):
+        with pytest.raises(ValueError):
+            _parse(body)
+
+    def test_entry_point(self, monkeypatch):
+        class _Request:
+            def __init__(self, headers, body):
+                self.headers, self.body = headers, body
+
+            def get_json(self, silent=False):
+                return self.body
+
+        monkeypatch.setenv("WEBHOOK_TOKEN", "secret")
+        assert main.webhook(_Request({}, {}))[1] == 403
+        assert main.webhook(_Request({"X-Webhook-Token": "sécret"}, {}))[1] == 403
+        assert main.webhook(_Request({"X-Webhook-Token": "secret"}, None))[1] == 400
+
+    def test_micro_batch(self):
+        flushes = []
+        batch = MicroBatch(lambda rows: flushes.append(rows) or len(rows), 100, 0.5)
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            results = list(executor.map(lambda i: batch.submit([i]), range(10)))
+        assert len(flushes) == 1 and sorted(flushes[0]) == list(range(10))
+        assert results == [10] * 10
+
+    def test_micro_batch_size(self):
+        flushes = []
+        batch = MicroBatch(lambda rows: flushes.append(rows), 2, 60)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(lambda i: batch.submit([i]), range(4)))
+        assert sorted(len(rows) for rows in flushes) == [2, 2]
+
+
+class TestLayout:
+    def test_current_layout(self):
+        table = bigquery.Table("project.Caresoft.Tickets")
+        assert _current_layout(table) == (None, ())
+        table.time_partitioning = bigquery.TimePartitioning(field="created_at")
+        table.clustering_fields = ["ticket_id"]
+        assert _current_layout(table) == ("created_at", ("ticket_id",))
+
+    def test_migration(self):
+        ddl = " ".join(_migration("Tickets", "created_at", ["ticket_id"], "x").split())
+        assert ddl == (
+            "CREATE TABLE Caresoft.Tickets__migrate_x "
+            "PARTITION BY DATE(created_at) CLUSTER BY ticket_id "
+            "AS SELECT * FROM Caresoft.Tickets; "
+            "DROP TABLE Caresoft.Tickets; "
+            "ALTER TABLE Caresoft.Tickets__migrate_x RENAME TO Tickets;"
+        )
+
+
+class TestLoad:
+    def test_dump_rolls_by_rows(self):
+        chunks = [[{"id": i}] * 500 for i in range(LOAD_FILE_ROWS * 2 // 500 + 20)]
+        assert sum(1 for _ in _dump(chunks)) == 3
+
+    def test_transaction(self):
+        merge = _merge("Tickets", "stage", [{"name": "ticket_id"}], "ticket_id", "u")
+        script = " ".join(
+            _transaction(merge, _watermark("Tickets", "stage", "u")).split()
+        )
+        assert script.startswith("BEGIN BEGIN TRANSACTION; MERGE Caresoft.Tickets T")
+        assert "; MERGE Caresoft._Watermarks T" in script
+        assert "COMMIT TRANSACTION; EXCEPTION WHEN ERROR THEN" in script
+        assert "CREATE TABLE" not in script
+
+    def test_merge_prunes(self):
+        merge = _merge(
+            "Tickets", "stage", [{"name": "ticket_id"}], "ticket_id", "u", "c"
+        )
+        script = " ".join(_transaction(merge, declare=_bound("stage", "c")).split())
+        assert script.startswith(
+            "DECLARE partition_bound DEFAULT ( SELECT MIN(c) FROM Caresoft.stage ); BEGIN"
+        )
+        assert (
+            "ON T.ticket_id = S.ticket_id "
+            "AND (T.c >= partition_bound OR T.c IS NULL) WHEN MATCHED"
+        ) in script
+
+
+class TestStorageWrite:
+    def test_sink_validation(self):
+        pipeline = dimension_pipelines["Agents"]
+        with pytest.raises(ValueError):
+            dataclasses.replace(pipeline, sink="storage_write")
+        with pytest.raises(ValueError):
+            dataclasses.replace(pipeline, sink="streaming")
+
+    def test_serialize(self):
+        schema = [
+            {"name": "id", "type": "INTEGER"},
+            {"name": "updated_at", "type": "TIMESTAMP"},
+            {
+                "name": "tags",
+                "type": "RECORD",
+                "mode": "REPEATED",
+                "fields": [{"name": "name", "type": "STRING"}],
+            },
+        ]
+        descriptor, batches = _serialize(
+            schema,
+            [[{"id": 1, "updated_at": "2022-06-22 07:00:00", "tags": [{"name": "a"}]}]],
+        )
+        assert [i.name for i in descriptor.field] == ["id", "updated_at", "tags"]
+        assert [len(batch) for batch in batches] == [1]
+
+    def test_converter(self):
+        convert = _converter(
+            [
+                {"name": "id", "type": "INTEGER"},
+                {"name": "active", "type": "BOOLEAN"},
+                {"name": "note", "type": "STRING"},
+            ]
+        )
+        assert convert({"id": "7", "active": "0", "note": {"a": [1]}}) == {
+            "id": 7,
+            "active": False,
+            "note": '{"a": [1]}',
+        }
+        assert convert({"id": 7.0, "active": True, "note": [1, 2]})["note"] == "[1, 2]"
+        for row in [{"id": 1.5}, {"id": "x"}, {"active": "yes"}]:
+            with pytest.raises(ValueError):
+                convert(row)
+
+
+class TestArchive:
+    def test_replay(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(archive, "ARCHIVE_URI", str(tmp_path))
+        chunks = [[{"id": i, "page": page} for i in range(300)] for page in range(3)]
+        assert list(archive.archive("Tickets", chunks)) == chunks
+
+        pipeline = archive.replay_pipeline(listing_pipelines["Tickets"])
+        replayed = list(pipeline.get(pipeline.params_fn()({})))
+        assert [len(rows) for rows in replayed] == [repo.API_COUNT, 400]
+        assert sum(replayed, []) == sum(chunks, [])
+        assert not list(
+            pipeline.get(
+                pipeline.params_fn()({"start": "2000-01-01", "end": "2000-01-02"})
+            )
+        )
+
+    def test_replay_deadline(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(archive, "ARCHIVE_URI", str(tmp_path))
+        for day in ["2022-06-01", "2022-06-02", "2022-06-02", "2022-06-03"]:
+            path = tmp_path / "Tickets" / f"dt={day}" / f"{uuid.uuid4().hex}.jsonl.gz"
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(gzip.compress(dumps({"id": day}) + b"\n"))
+
+        pipeline = archive.replay_pipeline(listing_pipelines["Tickets"])
+        with run_context() as context:
+            replayed = pipeline.get(pipeline.params_fn()({"start": "2022-06-02"}))
+            assert next(replayed) == [{"id": "2022-06-02"}]
+            context.deadline = time.monotonic()
+            assert not list(replayed)
+        assert context.pending_dates == ["2022-06-02", "2022-06-03"]
+
+
+class TestCodec:
+    def test_round_trip(self):
+        rows = fake_rows("TicketsDetails", 10) + [{"subject": "Đơn hàng ✓"}]
+        assert [loads(dumps(row) + b"\n") for row in rows] == rows
+
+    def test_decode_stats(self, clean_caresoft):
+        with run_context() as context:
+            list(listing_pipelines["Tickets"].get({"count": repo.API_COUNT}))
+        assert context.stats["fetch"]["decode_seconds"] > 0
+
+
 class TestTasks:
+    def test_details_limit(self, monkeypatch):
+        monkeypatch.setattr(tasks_service, "get_latency", lambda table: 0.5)
+        assert tasks_service._details_limit("TicketsDetails") == int(
+            (FUNCTION_TIMEOUT - DEADLINE_MARGIN)
+            * tasks_service.DETAILS_BUDGET_RATIO
+            / 0.5
+        )
+        monkeypatch.setattr(tasks_service, "get_latency", lambda table: None)
+        monkeypatch.setattr(repo, "_details_latency", 10.0)
+        assert tasks_service._details_limit("TicketsDetails") == repo.DETAILS_MIN_LIMIT
+
+    def test_changed_ids(self, monkeypatch):
+        stored = {
+            1: datetime(2022, 6, 22, 7, tzinfo=timezone.utc),
+            2: datetime(2022, 6, 22, 7, tzinfo=timezone.utc),
+        }
+        monkeypatch.setattr(
+            tasks_service,
+            "get_cursors",
+            lambda table, id_key, cursor_key, ids: {
+                i: stored[i] for i in ids if i in stored
+            },
+        )
+        rows = [
+            {"id": 1, "updated_at": "2022-06-22T07:00:00Z"},
+            {"id": 2, "updated_at": "2022-06-22 06:00:00"},
+            {"id": 2, "updated_at": "2022-06-22 08:00:00"},
+            {"id": 3, "updated_at": "2022-06-22T00:00:00+07:00"},
+            {"id": 4, "updated_at": "2022-06-22T00:00:00Z"},
+            {"id": 4, "updated_at": None},
+        ]
+        assert tasks_service._changed_ids(
+            "ContactsDetails", "id", "updated_at", rows
+        ) == {
+            2: datetime(2022, 6, 22, 8, tzinfo=timezone.utc),
+            3: datetime(2022, 6, 21, 17, tzinfo=timezone.utc),
+            4: None,
+        }
+
+    def test_plan_windows(self):
+        body = {"start": "2022-06-01T00:00:00", "end": "2022-06-04T00:00:00"}
+
+        def _pipeline(num_found: int):
+            return dataclasses.replace(
+                listing_pipelines["Tickets"],
+                count=lambda params: num_found,
+            )
+
+        assert tasks_service._plan_windows(
+            _pipeline(int(repo.BACKFILL_LIMIT * 2.5)), body
+        ) == [
+            {"start": "2022-06-01T00:00:00", "end": "2022-06-02T00:00:00"},
+            {"start": "2022-06-02T00:00:00", "end": "2022-06-03T00:00:00"},
+            {"start": "2022-06-03T00:00:00", "end": "2022-06-04T00:00:00"},
+        ]
+        assert tasks_service._plan_windows(_pipeline(0), body) == [body]
+        assert tasks_service._plan_windows(_pipeline(10**9), {}) == [
+            {"start": None, "end": None}
+        ]
+        assert tasks_service._plan_windows(
+            dataclasses.replace(listing_pipelines["Tickets"], count=None), body
+        ) == [body]
+
     def test_service(self, timeframe):
         res = create_cron_tasks_service(
             {
@@ -97,3 +628,22 @@ class TestTasks:
             }
         )
         assert res["tasks"] > 0
+
+
+class TestColdStart:
+    def test_import_time(self):
+        elapsed = float(
+            subprocess.run(
+                [
+                    sys.executable,
+                    "-c",
+                    "import time; start = time.perf_counter(); import main; "
+                    "print(time.perf_counter() - start)",
+                ],
+                capture_output=True,
+                check=True,
+                text=True,
+            ).stdout
+        )
+        print(f"import main: {elapsed:.3f}s")
+        assert elapsed < IMPORT_BUDGET
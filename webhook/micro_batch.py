@@ -0,0 +1,67 @@
+from typing import Any, Callable, Optional
+import threading
+import time
+
+
+class _Batch:
+    def __init__(self):
+        self.rows: list[Any] = []
+        self.created = time.monotonic()
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class MicroBatch:
+    """Group commit for concurrent callers.
+
+    Rows submitted within `max_delay` seconds of each other, up to
+    `max_size` rows, are flushed together by one caller. Every caller blocks
+    until the batch holding its rows is flushed and then gets the flush
+    result, or its error.
+    """
+
+    def __init__(
+        self,
+        flush_fn: Callable[[list[Any]], Any],
+        max_size: int,
+        max_delay: float,
+    ):
+        self.flush_fn = flush_fn
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._batch = _Batch()
+
+    def _seal(self, batch: _Batch) -> bool:
+        with self._lock:
+            if self._batch is not batch:
+                return False
+            self._batch = _Batch()
+            return True
+
+    def submit(self, rows: list[Any]) -> Any:
+        with self._lock:
+            batch = self._batch
+            if not batch.rows:
+                batch.created = time.monotonic()
+            batch.rows.extend(rows)
+            leader = len(batch.rows) >= self.max_size
+            if leader:
+                self._batch = _Batch()
+
+        timeout = max(batch.created + self.max_delay - time.monotonic(), 0)
+        if not leader and not batch.done.wait(timeout):
+            leader = self._seal(batch)
+        if leader:
+            try:
+                batch.result = self.flush_fn(batch.rows)
+            except Exception as e:
+                batch.error = e
+            finally:
+                batch.done.set()
+
+        batch.done.wait()
+        if batch.error:
+            raise batch.error
+        return batch.result
@@ -0,0 +1,67 @@
+from typing import Any
+
+from caresoft.pipeline import details_pipelines
+from caresoft.pipeline.interface import Pipeline
+from caresoft.repo import Data
+from db.bigquery import load
+from webhook.micro_batch import MicroBatch
+
+WEBHOOK_BATCH_SIZE = 500
+WEBHOOK_MAX_DELAY = 1
+
+RESOURCES = {
+    "ticket": "TicketsDetails",
+    "contact": "ContactsDetails",
+}
+
+
+def _load(pipeline: Pipeline):
+    def _flush(rows: Data) -> int:
+        return load(
+            pipeline.name,
+            pipeline.schema,
+            pipeline.id_key,
+            pipeline.cursor_key,
+            [pipeline.transform(rows)],
+            False,
+            pipeline.partition_key,
+            pipeline.cluster_keys,
+            pipeline.sink,
+        )
+
+    return _flush
+
+
+_batches = {
+    resource: MicroBatch(
+        _load(details_pipelines[table]),
+        WEBHOOK_BATCH_SIZE,
+        WEBHOOK_MAX_DELAY,
+    )
+    for resource, table in RESOURCES.items()
+}
+
+
+def _parse(body: Any) -> dict[str, Data]:
+    events: dict[str, Data] = {}
+    for event in body if isinstance(body, list) else [body]:
+        if not isinstance(event, dict):
+            raise ValueError(event)
+        for resource in RESOURCES:
+            if event.get(resource):
+                if not isinstance(event[resource], dict):
+                    raise ValueError(event)
+                events.setdefault(resource, []).append(event[resource])
+    if not events:
+        raise ValueError(body)
+    return events
+
+
+def webhook_service(body: Any):
+    return {
+        RESOURCES[resource]: {
+            "events": len(rows),
+            "output_rows": _batches[resource].submit(rows),
+        }
+        for resource, rows in _parse(body).items()
+    }